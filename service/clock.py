@@ -0,0 +1,83 @@
+"""Clocks for services - wall clock, and virtual clock for simulations"""
+
+import datetime
+import heapq
+import itertools
+import threading
+import time
+
+
+class SystemClock(object):
+    def now(self):
+        return datetime.datetime.now()
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def timer(self, length, function, args):
+        """ Calls function(*args) after length seconds. Returns object with .cancel() """
+        timer = threading.Timer(length, function, args)
+        timer.start()
+        return timer
+
+
+class VirtualTimer(object):
+    def __init__(self, run_at, function, args):
+        self.run_at = run_at
+        self.function = function
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class VirtualClock(object):
+    """ Clock that only advances when told to. Timers run when the clock passes them. """
+
+    def __init__(self, start):
+        self.current = start
+        self.timers = []
+        self.counter = itertools.count()
+
+    def now(self):
+        return self.current
+
+    def time(self):
+        return time.mktime(self.current.timetuple()) + self.current.microsecond / 1000000.0
+
+    def sleep(self, seconds):
+        self.advance_to(self.current + datetime.timedelta(seconds=seconds))
+
+    def timer(self, length, function, args):
+        timer = VirtualTimer(self.current + datetime.timedelta(seconds=length), function, args)
+        heapq.heappush(self.timers, (timer.run_at, next(self.counter), timer))
+        return timer
+
+    def next_timer_at(self):
+        while self.timers and self.timers[0][2].cancelled:
+            heapq.heappop(self.timers)
+        if self.timers:
+            return self.timers[0][0]
+        return None
+
+    def run_next_timer(self):
+        """ Advances to the next timer and runs it. Returns False if there are no timers. """
+        if self.next_timer_at() is None:
+            return False
+        run_at, _, timer = heapq.heappop(self.timers)
+        self.current = max(self.current, run_at)
+        timer.function(*timer.args)
+        return True
+
+    def advance_to(self, moment):
+        """ Advances to moment, running all timers due before it """
+        while True:
+            timer_at = self.next_timer_at()
+            if timer_at is None or timer_at > moment:
+                break
+            self.run_next_timer()
+        self.current = max(self.current, moment)
@@ -0,0 +1,35 @@
+import clock
+import datetime
+import unittest
+
+
+class TestVirtualClock(unittest.TestCase):
+    def setUp(self):
+        self.clock = clock.VirtualClock(datetime.datetime(2016, 3, 30, 8, 0))
+        self.calls = []
+
+    def call(self, name):
+        self.calls.append((name, self.clock.now()))
+
+    def test_timers(self):
+        self.clock.timer(120, self.call, ["second"])
+        self.clock.timer(60, self.call, ["first"])
+        cancelled = self.clock.timer(90, self.call, ["cancelled"])
+        cancelled.cancel()
+        self.assertEqual(self.clock.next_timer_at(), datetime.datetime(2016, 3, 30, 8, 1))
+        self.clock.sleep(600)
+        self.assertEqual(self.calls, [
+            ("first", datetime.datetime(2016, 3, 30, 8, 1)),
+            ("second", datetime.datetime(2016, 3, 30, 8, 2)),
+        ])
+        self.assertEqual(self.clock.now(), datetime.datetime(2016, 3, 30, 8, 10))
+        self.assertIsNone(self.clock.next_timer_at())
+
+    def test_run_next_timer(self):
+        self.assertFalse(self.clock.run_next_timer())
+        self.clock.timer(60, self.call, ["first"])
+        self.assertTrue(self.clock.run_next_timer())
+        self.assertEqual(self.clock.now(), datetime.datetime(2016, 3, 30, 8, 1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,17 +3,19 @@
 """Light control service
 
 Usage:
-    lights.py run <ip> [--debug] [--redis-host=<hostname>] [--redis-port=<port>]
+    lights.py run <ip> [--debug] [--redis-host=<hostname>] [--redis-port=<port>] [--stats-port=<port>]
 """
 
+import clock
 import docopt
-import datetime
+import health
 import json
 import ledcontroller
 import logging
 import os
 import programs
 import redis
+import stats
 
 
 class LightControlCommand(object):
@@ -28,15 +30,33 @@ class LightControlCommand(object):
         return u"LightControlCommand<%s: %s - %s>" % (self.command, self.group, self.source)
 
 
+GROUP_STATE_KEYS = ("on", "auto", "user-override", "color", "white_brightness", "rgb_brightness")
+LED_STATE_KEYS = ("on", "color", "white_brightness", "rgb_brightness")
+
+# Scene steps are applied in order. Steps with "unless" are skipped if the group
+# already matched the given state before the scene was applied.
+DEFAULT_SCENES = {
+    "night": {
+        "steps": [
+            {"on": True},
+            {"color": "white", "brightness": 0, "unless": {"color": "red"}},
+            {"color": "red", "brightness": 0},
+        ],
+    },
+}
+
+
 class LightControlService(object):
     def __init__(self, controller_ip, **kwargs):
-        self.led = ledcontroller.LedController(controller_ip)
+        self.led = kwargs.get("led") or ledcontroller.LedController(controller_ip)
+        self.clock = kwargs.get("clock") or clock.SystemClock()
+        self.stats = stats.ServiceStats("control")
         redis_args = {}
         if "redis_host" in kwargs and kwargs["redis_host"]:
             redis_args["host"] = kwargs["redis_host"]
         if "redis_port" in kwargs and kwargs["redis_port"]:
             redis_args["port"] = kwargs["redis_port"]
-        self.redis = redis.StrictRedis(**redis_args)
+        self.redis = kwargs.get("redis_class", stats.CountingStrictRedis)(self.stats, **redis_args)
 
         self.logger = logging.getLogger("lightcontrol-control")
         if kwargs.get("debug"):
@@ -48,13 +68,21 @@ class LightControlService(object):
         ch = logging.StreamHandler()
         ch.setFormatter(formatter)
         self.logger.addHandler(ch)
-        self.programs = programs.LightPrograms(**kwargs)
+        self.programs = programs.LightPrograms(stats=self.stats, **kwargs)
+        self.compiled_scenes = {}
+        self.heartbeat = health.Heartbeat("control", self.redis, "lightcontrol-control-pubsub", instance=controller_ip)
         self.set_group_names()
+        self.set_default_scenes()
 
     def set_group_names(self):
         for i, name in enumerate(["Sänky", "Ruokapöytä", "Keittiö", "Eteinen"]):
             self.redis.set("lightcontrol-group-%s-name" % (i + 1), name)
 
+    def set_default_scenes(self):
+        for scene, details in DEFAULT_SCENES.items():
+            if self.redis.setnx("lightcontrol-scene-%s" % scene, json.dumps(details)):
+                self.logger.info("Setting scene %s to defaults: %s.", scene, details)
+
     def get_redis(self, key, default_value=None):
         val = self.redis.get(key)
         if val is None:
@@ -90,7 +118,25 @@ class LightControlService(object):
             self.logger.debug("Sync: switching off %s", group_id)
             self.set_off(False, group_id, force=True)
 
-    def program_sync(self, group_id):
+    def get_group_defaults(self, group_id):
+        """ Returns default color and brightness for a group, falling back to global defaults """
+        group_color, group_brightness, color, brightness = self.redis.mget(
+            "lightcontrol-group-{group_id}-default-color".format(group_id=group_id),
+            "lightcontrol-group-{group_id}-default-brightness".format(group_id=group_id),
+            "lightcontrol-default-color",
+            "lightcontrol-default-brightness",
+        )
+        if group_color is not None:
+            color = group_color
+        if group_brightness is not None:
+            brightness = group_brightness
+        if color is None:
+            color = "white"
+        if brightness is None:
+            brightness = 100
+        return color, int(brightness)
+
+    def program_sync(self, group_id, color=None, brightness=None):
         group_on = self.is_group_on(group_id)
         if not group_on:
             self.logger.debug("Not syncing group %s with program settings, as it is off", group_id)
@@ -99,11 +145,32 @@ class LightControlService(object):
         if user_override:
             self.logger.debug("Not syncing group %s with program settings, as it is overridden by the user", group_id)
             return
-        color = self.get_redis("lightcontrol-default-color", "white")
-        brightness = int(self.get_redis("lightcontrol-default-brightness", 100))
+        if color is None or brightness is None:
+            color, brightness = self.get_group_defaults(group_id)
         self.set_color(color, group_id)
         self.set_brightness(brightness, group_id)
 
+    @stats.timed("program_sync_targets")
+    def program_sync_targets(self, targets):
+        """ Syncs groups listed in a batched program-sync message: {"<group_id>": {"color": ..., "brightness": ...}}
+
+        Same as program_sync for each group, but state is fetched and changes are executed as a single batch.
+        """
+        targets = dict((int(group_id), target) for group_id, target in targets.items())
+        states = self.get_group_states(sorted(targets))
+        operations = []
+        for group_id, target in sorted(targets.items()):
+            state = states[group_id]
+            if state.get("on") in (None, "False"):
+                self.logger.debug("Not syncing group %s with program settings, as it is off", group_id)
+                continue
+            if state.get("user-override") not in (None, "False"):
+                self.logger.debug("Not syncing group %s with program settings, as it is overridden by the user", group_id)
+                continue
+            for key_name, value in self.compile_target(state, {"color": target["color"], "brightness": target["brightness"]}):
+                operations.append((group_id, key_name, value))
+        self.execute_operations(operations, states)
+
     def set_auto_mode(self, group_id, mode):
         self.redis.set("lightcontrol-state-{group_id}-auto".format(group_id=group_id), mode)
 
@@ -111,8 +178,7 @@ class LightControlService(object):
         if not self.is_group_auto(group_id):
             self.logger.debug("Not processing automatic trigger for group %s, as it is marked as manually on", group_id)
             return
-        color = self.get_redis("lightcontrol-default-color", "white")
-        brightness = int(self.get_redis("lightcontrol-default-brightness", 100))
+        color, brightness = self.get_group_defaults(group_id)
         self.set_on(True, group_id)
         self.set_color(color, group_id)
         self.set_brightness(brightness, group_id)
@@ -134,13 +200,17 @@ class LightControlService(object):
         }
         return data
 
+    @stats.timed("run_operation")
     def run_operation(self, group_id, led_command, led_command_arg, key_name, force=False):
         redis_key = "lightcontrol-state-{group_id}-{key_name}".format(group_id=group_id, key_name=key_name)
         value = self.redis.get(redis_key)
         if value is not None:
             if value == str(led_command_arg) and not force:
-                self.logger.debug("Not running operation %s for group %s, as force=False and light is already in correct state (%s).", key_name, group_id, led_command_arg)
+                self.stats.incr("led:suppressed")
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug("Not running operation %s for group %s, as force=False and light is already in correct state (%s).", key_name, group_id, led_command_arg)
                 return
+        self.stats.incr("led:sent")
         if key_name in ("on", "off"):
             self.logger.debug("Executed %s for group %s", led_command, group_id)
             led_command(group_id)
@@ -164,11 +234,16 @@ class LightControlService(object):
             key = "white_brightness"
         else:
             key = "rgb_brightness"
+        brightness = self.normalize_brightness(brightness)
+        self.run_operation(group_id, self.led.set_brightness, brightness, key, kwargs.get("force", False))
+
+    @classmethod
+    def normalize_brightness(cls, brightness):
         if brightness < 5:
             brightness = 0
         if brightness > 95:
             brightness = 100
-        self.run_operation(group_id, self.led.set_brightness, brightness, key, kwargs.get("force", False))
+        return brightness
 
     def set_on(self, status, group_id, **kwargs):
         self.run_operation(group_id, self.led.on, True, "on", kwargs.get("force", False))
@@ -179,13 +254,262 @@ class LightControlService(object):
     def disabled_at_night(self, group_id):
         return self.get_redis("lightcontrol-group-%s-disabled-night" % group_id, False) not in (False, "False", "false")
 
+    def format_lightgroup(self, group_id, state):
+        """ Same as get_lightgroup, but from already fetched group state """
+        if state.get("color") != "white":
+            brightness_key = "rgb_brightness"
+        else:
+            brightness_key = "white_brightness"
+        return {
+            "on": state.get("on") in ("true", "True"),
+            "name": state.get("name"),
+            "color": state.get("color"),
+            "current_brightness": state.get(brightness_key),
+            "id": group_id,
+        }
+
+    def get_group_states(self, group_ids):
+        """ Fetches state of multiple groups with a single MULTI """
+        pipe = self.redis.pipeline()
+        for group_id in group_ids:
+            keys = ["lightcontrol-state-%s-%s" % (group_id, key_name) for key_name in GROUP_STATE_KEYS]
+            keys.append("lightcontrol-group-%s-name" % group_id)
+            pipe.mget(keys)
+        states = {}
+        for group_id, values in zip(group_ids, pipe.execute()):
+            states[group_id] = dict(zip(GROUP_STATE_KEYS + ("name",), values))
+        return states
+
+    @classmethod
+    def compile_target(cls, state, target, force=False):
+        """ Returns list of (key_name, value) operations needed for turning group from state to target.
+
+        target may contain "on" (True/False), "color" and "brightness". state is updated to match the target.
+        """
+        operations = []
+        if target.get("on") is not None:
+            value = bool(target["on"])
+            if force or state.get("on") != str(value):
+                operations.append(("on", value))
+                state["on"] = str(value)
+            if not value:
+                return operations
+        color = target.get("color")
+        if color is not None and (force or state.get("color") != color):
+            operations.append(("color", color))
+            state["color"] = color
+        brightness = target.get("brightness")
+        if brightness is not None:
+            brightness = cls.normalize_brightness(int(brightness))
+            if state.get("color") in (None, "white"):
+                key_name = "white_brightness"
+            else:
+                key_name = "rgb_brightness"
+            if force or state.get(key_name) != str(brightness):
+                operations.append((key_name, brightness))
+                state[key_name] = str(brightness)
+        return operations
+
+    def compile_scene(self, scene_data, state):
+        """ Returns operations for applying scene to a group, skipping steps that are already satisfied.
+
+        Compiled operations are cached per scene data and group state. state is updated to match the scene.
+        """
+        cache_key = (scene_data,) + tuple(state.get(key) for key in LED_STATE_KEYS)
+        compiled = self.compiled_scenes.get(cache_key)
+        if compiled is None:
+            self.stats.incr("scenes:compiled")
+            initial_state = dict(state)
+            operations = []
+            for step in json.loads(scene_data)["steps"]:
+                unless = step.get("unless")
+                if unless and all(initial_state.get(key) == value for key, value in unless.items()):
+                    continue
+                operations.extend(self.compile_target(state, step))
+            if len(self.compiled_scenes) > 1000:
+                self.compiled_scenes.clear()
+            compiled = self.compiled_scenes[cache_key] = (operations, dict((key, state.get(key)) for key in LED_STATE_KEYS))
+        state.update(compiled[1])
+        return list(compiled[0])
+
+    @stats.timed("apply_scene")
+    def apply_scene(self, scene, group_ids, extra_state=None):
+        """ Applies scene to groups with a single batched execution """
+        scene_data = self.redis.get("lightcontrol-scene-%s" % scene)
+        if scene_data is None:
+            self.logger.error("Scene %s does not exist", scene)
+            return
+        states = self.get_group_states(group_ids)
+        operations = []
+        for group_id in group_ids:
+            for key_name, value in self.compile_scene(scene_data, states[group_id]):
+                operations.append((group_id, key_name, value))
+        self.execute_operations(operations, states, extra_state)
+
+    def run_scene_command(self, data):
+        """ Applies scene from {"command": "scene", "scene": <name>, "group": <id, 0 or list of ids>, "source": ...} """
+        group_ids = data["group"]
+        if group_ids == 0:
+            group_ids = list(range(1, 5))
+        elif not isinstance(group_ids, list):
+            group_ids = [group_ids]
+        extra_state = {}
+        if data.get("source") == "manual":
+            for group_id in group_ids:
+                extra_state["lightcontrol-state-{group_id}-auto".format(group_id=group_id)] = False
+        elif data.get("source") == "trigger" and self.programs.is_night(self.clock.now()):
+            group_ids = [group_id for group_id in group_ids if not self.disabled_at_night(group_id)]
+        self.apply_scene(data["scene"], group_ids, extra_state)
+
+    def get_led_command(self, group_id, key_name, value):
+        if key_name == "on":
+            if value:
+                return (self.led.on, group_id)
+            return (self.led.off, group_id)
+        if key_name == "color":
+            return (self.led.set_color, value, group_id)
+        return (self.led.set_brightness, value, group_id)
+
+    @stats.timed("execute_operations")
+    def execute_operations(self, operations, states, extra_state=None):
+        """ Executes (group_id, key_name, value) operations in a single batch
+
+        LED commands are sent with a single batch_run, state is written with a single MULTI and
+        all changed groups are sent in a single broadcast. states must already reflect the operations.
+        """
+        if operations:
+            self.stats.incr("led:sent", len(operations))
+            self.logger.debug("Executing batch: %s", operations)
+            self.led.batch_run(*[self.get_led_command(group_id, key_name, value) for group_id, key_name, value in operations])
+        pipe = self.redis.pipeline()
+        for group_id, key_name, value in operations:
+            pipe.set("lightcontrol-state-%s-%s" % (group_id, key_name), value)
+        for redis_key, value in (extra_state or {}).items():
+            pipe.set(redis_key, value)
+        pipe.execute()
+        group_ids = sorted(set(group_id for group_id, _, _ in operations))
+        if group_ids:
+            groups = [self.format_lightgroup(group_id, states[group_id]) for group_id in group_ids]
+            self.redis.publish("home:broadcast:generic", json.dumps({"key": "lightcontrol", "content": {"groups": groups}}))
+
+    def bulk_apply(self, targets, source, force=False):
+        """ Applies {"<group_id>": {"on": ..., "color": ..., "brightness": ...}} to multiple groups at once """
+        targets = dict((int(group_id), target) for group_id, target in targets.items())
+        states = self.get_group_states(sorted(targets))
+        operations = []
+        extra_state = {}
+        night = source == "trigger" and self.programs.is_night(self.clock.now())
+        for group_id, target in sorted(targets.items()):
+            auto_key = "lightcontrol-state-%s-auto" % group_id
+            if night and self.disabled_at_night(group_id):
+                self.logger.debug("Skipping bulk-apply for group %s - disabled during night", group_id)
+                continue
+            if source == "manual":
+                # Same as with individual commands: manual changes switch the group to manual control,
+                # and turning lights off switches back to automatic mode.
+                extra_state[auto_key] = target.get("on") is False
+            elif states[group_id].get("auto") not in (None, "True"):
+                self.logger.debug("Skipping automatic bulk-apply for %s as group is marked as manually controlled.", group_id)
+                continue
+            for key_name, value in self.compile_target(states[group_id], target, force):
+                operations.append((group_id, key_name, value))
+        self.execute_operations(operations, states, extra_state)
+
+    @stats.timed("get_snapshot")
+    def get_snapshot(self):
+        """ Returns state of all groups, programs, timers and defaults from a single MULTI, retried if the program list changes """
+        group_ids = list(range(1, 5))
+        program_fields = ("", "-next_start_at", "-next_end_at")
+        group_fields = (
+            ("name", "lightcontrol-group-%s-name"),
+            ("default_color", "lightcontrol-group-%s-default-color"),
+            ("default_brightness", "lightcontrol-group-%s-default-brightness"),
+            ("disabled_night", "lightcontrol-group-%s-disabled-night"),
+            ("timer_expires_at", "lightcontrol-timer-%s-expires-at"),
+        )
+        default_keys = (
+            ("color", "lightcontrol-default-color"),
+            ("brightness", "lightcontrol-default-brightness"),
+            ("timer_length", "lightcontrol-timer-length"),
+            ("timer_max_length", "lightcontrol-timer-max-length"),
+        )
+        with self.redis.pipeline() as pipe:
+            while True:
+                try:
+                    # Program names are needed for queuing the MULTI. If the list changes before EXEC, WATCH aborts the transaction.
+                    pipe.watch("lightcontrol-programs")
+                    program_names = sorted(pipe.smembers("lightcontrol-programs"))
+                    pipe.multi()
+                    for group_id in group_ids:
+                        keys = ["lightcontrol-state-%s-%s" % (group_id, key_name) for key_name in GROUP_STATE_KEYS]
+                        keys.extend(key % group_id for _, key in group_fields)
+                        pipe.mget(keys)
+                    for name in program_names:
+                        pipe.mget(["lightcontrol-program-%s%s" % (name, field) for field in program_fields] + ["lightprogram-%s-running" % name])
+                    pipe.mget([key for _, key in default_keys])
+                    pipe.smembers("lightcontrol-holidays")
+                    results = pipe.execute()
+                    break
+                except redis.WatchError:
+                    self.stats.incr("snapshot:retries")
+
+        groups = []
+        for group_id, values in zip(group_ids, results):
+            state = dict(zip(GROUP_STATE_KEYS + tuple(field for field, _ in group_fields), values))
+            group = dict(state)
+            group.update(self.format_lightgroup(group_id, state))
+            groups.append(group)
+        programs_data = []
+        for name, (data, next_start_at, next_end_at, running) in zip(program_names, results[len(group_ids):]):
+            if data is None:
+                continue
+            program = json.loads(data)
+            program.update({
+                "name": name,
+                "next_start_at": next_start_at,
+                "next_end_at": next_end_at,
+                "running": running in ("true", "True"),
+            })
+            programs_data.append(program)
+        defaults = dict(zip([field for field, _ in default_keys], results[-2]))
+        return {
+            "generated_at": self.clock.now().isoformat(),
+            "groups": groups,
+            "programs": programs_data,
+            "defaults": defaults,
+            "holidays": sorted(results[-1]),
+        }
+
+    def publish_snapshot(self, reply_to=None):
+        self.redis.publish(reply_to or "lightcontrol-snapshot-pubsub", json.dumps(self.get_snapshot()))
+
+    @stats.timed("process_command")
     def process_command(self, data):
+        # Commands covering multiple groups at once
+        if data.get("command") == "program-sync" and "targets" in data:
+            self.program_sync_targets(data["targets"])
+            return
+        if data.get("command") == "snapshot":
+            self.publish_snapshot(data.get("reply_to"))
+            return
+        if data.get("command") == "bulk-apply":
+            self.bulk_apply(data["groups"], data.get("source"), data.get("force", False))
+            return
+        if data.get("command") == "scene":
+            self.run_scene_command(data)
+            return
+        if data.get("command") == "night":
+            self.run_scene_command(dict(data, scene="night"))
+            return
         if data["group"] == 0:
             for group in range(1, 5):
                 data["group"] = group
-                self.process_command(data)
+                self.process_group_command(data)
             return
+        self.process_group_command(data)
 
+    def process_group_command(self, data):
+        """ Processes command for a single group. Not timed separately - timing is recorded by process_command. """
         self.logger.debug("process_command received %s", data)
         command = LightControlCommand(data)
 
@@ -195,12 +519,12 @@ class LightControlService(object):
                     self.logger.debug("Skipping automatic %s for %s as group is marked as manually controlled.", command.command, command.group)
                     return
 
-        if command.command in ("set_color", "set_brightness", "on", "night", "auto-triggered"):
+        if command.command in ("set_color", "set_brightness", "on", "auto-triggered"):
             if command.source == "manual":
                 self.logger.debug("Setting group %s to manual control.", command.group)
                 self.set_auto_mode(command.group, False)
             elif command.source == "trigger":
-                if self.programs.is_night(datetime.datetime.now()):
+                if self.programs.is_night(self.clock.now()):
                     if self.disabled_at_night(command.group):
                         self.logger.debug("Skipping %s for group %s - disabled during night", command.command, command.group)
                         return
@@ -228,27 +552,27 @@ class LightControlService(object):
         if command.command == "program-sync":
             self.program_sync(command.group)
             return
-        if command.command == "night":
-            self.set_on(True, command.group)
-            color = self.get_redis("lightcontrol-state-{group}-color".format(group=command.group), "white")
-            if color != "red":
-                self.set_color("white", command.group)
-                self.set_brightness(0, command.group)
-            self.set_color("red", command.group)
-            self.set_brightness(0, command.group)
-            return
         self.logger.error("Unhandled data: %s", command)
 
     def run(self):
         pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
         pubsub.subscribe("lightcontrol-control-pubsub")
+        self.heartbeat.start()
         for message in pubsub.listen():
             try:
                 command = json.loads(message["data"])
             except (ValueError, TypeError):
                 self.logger.warning("Received invalid command from pubsub: %s", message)
                 continue
-            self.process_command(command)
+            if self.heartbeat.is_ping(command):
+                self.heartbeat.beat(command)
+                continue
+            try:
+                self.process_command(command)
+            except Exception:
+                # Keep processing - a single invalid command must not stop the service
+                self.stats.incr("errors")
+                self.logger.exception("Processing %s failed", command)
 
 
 def main(args):
@@ -257,6 +581,8 @@ def main(args):
         "redis_port": args.get("--redis-post"),
     }
     lcs = LightControlService(arguments["<ip>"], debug=arguments.get("--debug", False), **kwargs)
+    if args.get("--stats-port"):
+        stats.start_server(lcs.stats, args["--stats-port"])
     lcs.run()
 
 if __name__ == '__main__':
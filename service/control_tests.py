@@ -0,0 +1,125 @@
+import clock
+import control
+import datetime
+import fake_redis
+import simulate
+import unittest
+
+
+class BatchRecordingLedController(simulate.RecordingLedController):
+    def __init__(self, virtual_clock):
+        super(BatchRecordingLedController, self).__init__(virtual_clock)
+        self.batches = 0
+
+    def batch_run(self, *commands):
+        self.batches += 1
+        super(BatchRecordingLedController, self).batch_run(*commands)
+
+
+class TestCompileTarget(unittest.TestCase):
+    def test_switch_on(self):
+        state = {"on": "False", "color": "white", "white_brightness": "100"}
+        operations = control.LightControlService.compile_target(state, {"on": True, "color": "red", "brightness": 50})
+        self.assertEqual(operations, [("on", True), ("color", "red"), ("rgb_brightness", 50)])
+        self.assertEqual(state["on"], "True")
+        self.assertEqual(state["rgb_brightness"], "50")
+
+    def test_already_satisfied(self):
+        state = {"on": "True", "color": "white", "white_brightness": "100"}
+        self.assertEqual(control.LightControlService.compile_target(state, {"on": True, "color": "white", "brightness": 97}), [])
+        operations = control.LightControlService.compile_target(state, {"on": True, "color": "white", "brightness": 97}, force=True)
+        self.assertEqual(operations, [("on", True), ("color", "white"), ("white_brightness", 100)])
+
+    def test_switch_off(self):
+        state = {"on": "True", "color": "white"}
+        operations = control.LightControlService.compile_target(state, {"on": False, "color": "red", "brightness": 0})
+        self.assertEqual(operations, [("on", False)])
+        self.assertEqual(state["color"], "white")
+
+
+class TestBatchCommands(unittest.TestCase):
+    def setUp(self):
+        self.clock = clock.VirtualClock(datetime.datetime(2016, 3, 30, 12, 0))
+        self.led = BatchRecordingLedController(self.clock)
+        fake_redis.FakeCountingRedis.reset()
+        self.control = control.LightControlService("test", led=self.led, clock=self.clock, redis_class=fake_redis.FakeCountingRedis)
+        self.redis = self.control.redis
+
+    def set_state(self, group_id, **state):
+        for key_name, value in state.items():
+            self.redis.set("lightcontrol-state-%s-%s" % (group_id, key_name), value)
+
+    def test_bulk_apply(self):
+        self.set_state(1, on="True", color="white", white_brightness="100")
+        self.set_state(2, on="False")
+        self.control.bulk_apply({"1": {"on": True, "color": "white", "brightness": 100}, "2": {"on": True, "brightness": 40}}, "manual")
+        self.assertEqual(self.led.batches, 1)
+        self.assertEqual([(command["command"], command["group"]) for command in self.led.commands], [("on", 2), ("set_brightness", 2)])
+        self.assertEqual(self.redis.get("lightcontrol-state-2-white_brightness"), "40")
+        self.assertEqual(self.redis.get("lightcontrol-state-1-auto"), "False")
+
+    def test_bulk_apply_skips_manual_groups(self):
+        self.set_state(1, on="False", auto="False")
+        self.set_state(2, on="False")
+        self.control.bulk_apply({"1": {"on": True}, "2": {"on": True}}, "trigger")
+        self.assertEqual([command["group"] for command in self.led.commands], [2])
+
+    def test_bulk_apply_disabled_at_night(self):
+        self.clock.advance_to(datetime.datetime(2016, 3, 31, 2, 0))
+        self.set_state(1, on="False")
+        self.set_state(2, on="False")
+        self.redis.set("lightcontrol-group-2-disabled-night", "true")
+        self.control.bulk_apply({"1": {"on": True}, "2": {"on": True}}, "trigger")
+        self.assertEqual([command["group"] for command in self.led.commands], [1])
+        self.control.bulk_apply({"2": {"on": True}}, "manual")
+        self.assertEqual([command["group"] for command in self.led.commands], [1, 2])
+
+    def test_compile_scene(self):
+        scene_data = self.redis.get("lightcontrol-scene-night")
+        state = {"on": "False", "color": "white", "white_brightness": "100"}
+        operations = self.control.compile_scene(scene_data, state)
+        self.assertEqual(operations, [("on", True), ("white_brightness", 0), ("color", "red"), ("rgb_brightness", 0)])
+        self.assertEqual(state["color"], "red")
+        # White step is skipped, as the group is already red
+        state = {"on": "True", "color": "red", "rgb_brightness": "50"}
+        self.assertEqual(self.control.compile_scene(scene_data, state), [("rgb_brightness", 0)])
+        state = {"on": "True", "color": "red", "rgb_brightness": "0"}
+        self.assertEqual(self.control.compile_scene(scene_data, state), [])
+        state = {"on": "False", "color": "white", "white_brightness": "100"}
+        self.assertEqual(len(self.control.compile_scene(scene_data, state)), 4)
+        self.assertEqual(self.control.stats.counters["scenes:compiled"], 3)
+
+    def test_night_for_all_groups(self):
+        for group_id in range(1, 5):
+            self.set_state(group_id, on="False", color="white")
+        self.set_state(4, on="True", color="red", rgb_brightness="0")
+        self.control.process_command({"command": "night", "group": 0, "source": "manual"})
+        self.assertEqual(self.led.batches, 1)
+        self.assertEqual(set(command["group"] for command in self.led.commands), set([1, 2, 3]))
+        self.assertEqual(self.redis.get("lightcontrol-state-2-color"), "red")
+        self.assertEqual(self.redis.get("lightcontrol-state-4-auto"), "False")
+
+    def test_fan_out_is_timed_once(self):
+        self.control.process_command({"command": "on", "group": 0, "source": "manual"})
+        self.assertEqual(len(self.led.commands), 4)
+        self.assertEqual(self.control.stats.dump()["timings"]["process_command"]["count"], 1)
+
+    def test_program_sync_targets(self):
+        self.set_state(1, on="True", color="white", white_brightness="100")
+        self.set_state(2, on="False", color="white")
+        self.set_state(3, **{"on": "True", "color": "white", "user-override": "True"})
+        self.set_state(4, on="True", color="red", rgb_brightness="0")
+        targets = dict((str(group_id), {"color": "white", "brightness": 50}) for group_id in range(1, 5))
+        targets["4"] = {"color": "red", "brightness": 0}
+        self.control.process_command({"command": "program-sync", "group": 0, "source": "program", "targets": targets})
+        self.assertEqual(self.led.batches, 1)
+        self.assertEqual([(command["command"], command["group"], command["arg"]) for command in self.led.commands], [("set_brightness", 1, 50)])
+        self.assertEqual(len(fake_redis.FakeCountingRedis.published_on("home:broadcast:generic")), 1)
+        self.assertEqual(self.redis.get("lightcontrol-state-1-white_brightness"), "50")
+        # Already synced - nothing is sent
+        self.control.program_sync_targets(targets)
+        self.assertEqual(self.led.batches, 1)
+        self.assertEqual(len(fake_redis.FakeCountingRedis.published_on("home:broadcast:generic")), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+"""In-memory Redis for unit tests, backed by fakeredis
+
+FakeCountingRedis can be passed to services as redis_class. All clients share
+a single in-memory database of the test process - call FakeCountingRedis.reset()
+in setUp. Published messages are collected to FakeCountingRedis.published
+instead of being delivered.
+"""
+
+import fakeredis
+
+
+class FakeCountingRedis(fakeredis.FakeStrictRedis):
+    published = []
+
+    def __init__(self, stats, **kwargs):
+        super(FakeCountingRedis, self).__init__(decode_responses=True, singleton=True)
+        self.stats = stats
+
+    @classmethod
+    def reset(cls):
+        cls(None).flushall()
+        del cls.published[:]
+
+    @classmethod
+    def published_on(cls, channel):
+        return [message for published_channel, message in cls.published if published_channel == channel]
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return super(FakeCountingRedis, self).pipeline(transaction)
+
+    def publish(self, channel, message):
+        self.published.append((channel, message))
+        return 0
@@ -0,0 +1,91 @@
+"""Service health - heartbeats and backpressure flag
+
+Services with a pubsub loop publish a heartbeat ping to their own input
+channel. When the loop gets to the ping, the time it spent waiting is
+reported as loop lag to lightcontrol-health-<name> and
+lightcontrol-health-pubsub. A stalled or dead loop stops reporting.
+
+Services running multiple instances (control, one per bridge) give each
+instance its own name, <service>-<instance>. Instances sharing an input
+channel only report their own pings. Reporting instances are registered to
+lightcontrol-health-instances ({name: service}), so that the watchdog notices
+when one of them stops reporting.
+
+Watchdog sets lightcontrol-backpressure when consumers are lagging behind.
+Producers check it with Backpressure.active() and shed or coalesce load.
+"""
+
+import json
+import os
+import threading
+import time
+
+
+class Heartbeat(object):
+    def __init__(self, service, redis, channel=None, interval=5, instance=None):
+        self.service = service
+        if instance is None:
+            self.name = service
+        else:
+            self.name = "%s-%s" % (service, instance)
+        self.pid = os.getpid()
+        self.redis = redis
+        self.channel = channel
+        self.interval = interval
+        self.thread = None
+
+    @classmethod
+    def is_ping(cls, data):
+        return isinstance(data, dict) and data.get("command") == "heartbeat"
+
+    def start(self):
+        """ Starts publishing pings to the input channel """
+        if self.channel is None or self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.ping_loop, name="lightcontrol-heartbeat")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def ping_loop(self):
+        while True:
+            self.redis.publish(self.channel, json.dumps({"command": "heartbeat", "service": self.service, "instance": self.name, "pid": self.pid, "ts": time.time()}))
+            time.sleep(self.interval)
+
+    def beat(self, ping):
+        """ Called by the service loop when it receives a ping. Returns False for pings of other instances. """
+        if ping.get("instance") != self.name or ping.get("pid") != self.pid:
+            return False
+        self.report(time.time() - ping["ts"])
+        return True
+
+    def report(self, lag):
+        data = {
+            "service": self.service,
+            "instance": self.name,
+            "ts": time.time(),
+            "lag": lag,
+            "interval": self.interval,
+            "pid": self.pid,
+        }
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hset("lightcontrol-health-instances", self.name, self.service)
+        pipe.setex("lightcontrol-health-%s" % self.name, int(self.interval * 3), json.dumps(data))
+        pipe.publish("lightcontrol-health-pubsub", json.dumps(data))
+        pipe.execute()
+
+
+class Backpressure(object):
+    """ Cached view of lightcontrol-backpressure, refreshed at most once per refresh_interval """
+
+    def __init__(self, redis, refresh_interval=1):
+        self.redis = redis
+        self.refresh_interval = refresh_interval
+        self.checked_at = 0
+        self.is_active = False
+
+    def active(self):
+        now = time.time()
+        if now - self.checked_at > self.refresh_interval:
+            self.checked_at = now
+            self.is_active = bool(self.redis.exists("lightcontrol-backpressure"))
+        return self.is_active
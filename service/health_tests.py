@@ -0,0 +1,89 @@
+import clock
+import datetime
+import fake_redis
+import health
+import json
+import programs
+import time
+import triggers
+import unittest
+
+
+class TestHeartbeat(unittest.TestCase):
+    def setUp(self):
+        fake_redis.FakeCountingRedis.reset()
+        self.redis = fake_redis.FakeCountingRedis(None)
+        self.heartbeat = health.Heartbeat("control", self.redis, "lightcontrol-control-pubsub", instance="10.0.0.1")
+
+    def ping(self, **kwargs):
+        data = {"command": "heartbeat", "service": "control", "instance": self.heartbeat.name, "pid": self.heartbeat.pid, "ts": time.time() - 1}
+        data.update(kwargs)
+        return data
+
+    def test_beat(self):
+        self.assertTrue(health.Heartbeat.is_ping(self.ping()))
+        self.assertTrue(self.heartbeat.beat(self.ping()))
+        data = json.loads(self.redis.get("lightcontrol-health-control-10.0.0.1"))
+        self.assertEqual(data["instance"], "control-10.0.0.1")
+        self.assertGreaterEqual(data["lag"], 1)
+        self.assertEqual(self.redis.hgetall("lightcontrol-health-instances"), {"control-10.0.0.1": "control"})
+        self.assertEqual(len(fake_redis.FakeCountingRedis.published_on("lightcontrol-health-pubsub")), 1)
+
+    def test_pings_of_other_instances_are_ignored(self):
+        self.assertFalse(self.heartbeat.beat(self.ping(instance="control-10.0.0.2")))
+        self.assertFalse(self.heartbeat.beat(self.ping(pid=self.heartbeat.pid + 1)))
+        self.assertIsNone(self.redis.get("lightcontrol-health-control-10.0.0.1"))
+        self.assertEqual(fake_redis.FakeCountingRedis.published, [])
+
+
+class TestBackpressure(unittest.TestCase):
+    def setUp(self):
+        fake_redis.FakeCountingRedis.reset()
+        self.redis = fake_redis.FakeCountingRedis(None)
+
+    def test_active(self):
+        backpressure = health.Backpressure(self.redis, refresh_interval=60)
+        self.assertFalse(backpressure.active())
+        self.redis.set("lightcontrol-backpressure", "{}")
+        # Cached until refresh_interval has passed
+        self.assertFalse(backpressure.active())
+        backpressure.refresh_interval = 0
+        backpressure.checked_at = 0
+        self.assertTrue(backpressure.active())
+
+    def test_triggers_are_coalesced(self):
+        virtual_clock = clock.VirtualClock(datetime.datetime(2016, 3, 30, 12, 0))
+        light_triggers = triggers.LightTriggers(redis_class=fake_redis.FakeCountingRedis, clock=virtual_clock)
+        light_triggers.process_command({"key": "bed"})
+        light_triggers.process_command({"key": "bed"})
+        self.assertEqual(len(fake_redis.FakeCountingRedis.published_on("lightcontrol-timer-pubsub")), 2)
+        self.redis.set("lightcontrol-backpressure", "{}")
+        light_triggers.backpressure.refresh_interval = 0
+        light_triggers.process_command({"key": "bed"})
+        self.assertEqual(len(fake_redis.FakeCountingRedis.published_on("lightcontrol-timer-pubsub")), 2)
+        virtual_clock.advance_to(datetime.datetime(2016, 3, 30, 12, 0, light_triggers.coalesce_window + 1))
+        light_triggers.process_command({"key": "bed"})
+        self.assertEqual(len(fake_redis.FakeCountingRedis.published_on("lightcontrol-timer-pubsub")), 3)
+        self.assertEqual(light_triggers.stats.dump()["counters"]["backpressure:coalesced"], 1)
+
+    def test_program_sync_is_shed(self):
+        light_programs = programs.LightPrograms(redis_class=fake_redis.FakeCountingRedis)
+        light_programs.backpressure.refresh_interval = 0
+        self.redis.set("lightcontrol-backpressure", "{}")
+        targets = {
+            None: {"color": "white", "brightness": 50, "sync": False},
+            1: {"color": "white", "brightness": 50, "sync": True},
+            2: {"color": "white", "brightness": 100, "sync": False},
+        }
+        self.assertEqual(light_programs.apply_targets(targets), {})
+        self.assertEqual(self.redis.get("lightcontrol-default-brightness"), "50")
+        self.assertEqual(self.redis.get("lightcontrol-group-2-default-brightness"), "100")
+        self.assertIsNone(self.redis.get("lightcontrol-group-1-default-brightness"))
+        self.assertEqual(light_programs.stats.dump()["counters"]["backpressure:shed"], 1)
+        # Shed target is synced once backpressure is released
+        self.redis.delete("lightcontrol-backpressure")
+        self.assertEqual(light_programs.apply_targets(targets), {1: {"color": "white", "brightness": 50}})
+        self.assertEqual(len(fake_redis.FakeCountingRedis.published_on("lightcontrol-control-pubsub")), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+"""Occupancy model - adapts timer lengths to recent trigger rates
+
+Busy rooms are triggered again and again right after the timer has switched
+the lights off. Each group keeps timestamps of its recent triggers in a small
+ring buffer, and timer length is scaled up with the trigger rate.
+
+Flaps (lights switched on again soon after the timer switched them off) are
+counted for the adaptive timer, and for comparison, for a fixed timer
+("baseline_flaps"), estimated from gaps between consecutive triggers.
+"""
+
+import array
+import threading
+
+
+class GroupOccupancy(object):
+    def __init__(self, size):
+        self.triggers = array.array("d", [0.0] * size)
+        self.position = 0
+        self.count = 0
+        self.last_trigger_at = None
+        self.last_base_length = None
+        self.last_length = None
+        self.off_at = None
+        self.flaps = 0
+        self.baseline_flaps = 0
+
+    def add(self, timestamp):
+        self.triggers[self.position] = timestamp
+        self.position = (self.position + 1) % len(self.triggers)
+        self.count = min(self.count + 1, len(self.triggers))
+
+    def triggers_since(self, since, until=None):
+        """ Number of triggers at or after since, and before until """
+        size = len(self.triggers)
+        count = 0
+        for i in range(1, self.count + 1):
+            timestamp = self.triggers[(self.position - i) % size]
+            if timestamp < since:
+                break
+            if until is None or timestamp < until:
+                count += 1
+        return count
+
+    def dump(self):
+        return {
+            "last_trigger_at": self.last_trigger_at,
+            "last_length": self.last_length,
+            "flaps": self.flaps,
+            "baseline_flaps": self.baseline_flaps,
+        }
+
+
+class OccupancyModel(object):
+    def __init__(self, size=64, window=3600, flap_window=120, max_multiplier=4):
+        self.size = size
+        self.window = window
+        self.flap_window = flap_window
+        self.max_multiplier = max_multiplier
+        self.groups = {}
+        self.lock = threading.Lock()
+
+    def get_group(self, group_id):
+        if group_id not in self.groups:
+            self.groups[group_id] = GroupOccupancy(self.size)
+        return self.groups[group_id]
+
+    def record_trigger(self, group_id, timestamp, base_length):
+        """ Records a trigger.
+
+        Returns (flapped, baseline_flapped): whether the trigger switched lights back on soon after
+        the timer expired, and whether that would have happened with a fixed base_length timer.
+        """
+        with self.lock:
+            group = self.get_group(group_id)
+            flapped = baseline_flapped = False
+            if group.off_at is not None and timestamp - group.off_at <= self.flap_window:
+                group.flaps += 1
+                flapped = True
+            if group.last_trigger_at is not None:
+                gap = timestamp - group.last_trigger_at
+                if group.last_base_length < gap <= group.last_base_length + self.flap_window:
+                    group.baseline_flaps += 1
+                    baseline_flapped = True
+            group.off_at = None
+            group.last_trigger_at = timestamp
+            group.last_base_length = base_length
+            group.add(timestamp)
+            return flapped, baseline_flapped
+
+    def record_off(self, group_id, timestamp):
+        with self.lock:
+            self.get_group(group_id).off_at = timestamp
+
+    def trigger_rate(self, group_id, timestamp):
+        """ Triggers per second during the window before timestamp. Trigger at timestamp is not counted. """
+        with self.lock:
+            return float(self.get_group(group_id).triggers_since(timestamp - self.window, timestamp)) / self.window
+
+    def timer_length(self, group_id, base_length, timestamp, max_length=None):
+        """ Scales base_length with the number of triggers expected during a single base_length timer """
+        density = self.trigger_rate(group_id, timestamp) * base_length
+        length = base_length * min(self.max_multiplier, 1 + density)
+        if max_length is not None:
+            length = min(length, max(max_length, base_length))
+        with self.lock:
+            self.get_group(group_id).last_length = length
+        return length
+
+    def dump(self, group_id=None):
+        with self.lock:
+            if group_id is not None:
+                return self.get_group(group_id).dump()
+            return dict((group_id, group.dump()) for group_id, group in self.groups.items())
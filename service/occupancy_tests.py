@@ -0,0 +1,45 @@
+import occupancy
+import unittest
+
+
+class TestOccupancyModel(unittest.TestCase):
+    def setUp(self):
+        self.occupancy = occupancy.OccupancyModel(size=8, window=3600, flap_window=120, max_multiplier=4)
+
+    def test_ring_buffer(self):
+        for i in range(20):
+            self.occupancy.record_trigger(1, 1000 + i, 60)
+        group = self.occupancy.get_group(1)
+        self.assertEqual(group.count, 8)
+        self.assertEqual(group.triggers_since(0), 8)
+        self.assertEqual(group.triggers_since(1015), 5)
+
+    def test_idle_group_uses_base_length(self):
+        self.occupancy.record_trigger(1, 10000, 900)
+        self.assertEqual(self.occupancy.timer_length(1, 900, 10000), 900)
+        self.occupancy.record_trigger(1, 20000, 120)
+        self.assertEqual(self.occupancy.timer_length(1, 120, 20000), 120)
+
+    def test_busy_group_gets_longer_timer(self):
+        for i in range(4):
+            self.occupancy.record_trigger(1, 10000 + i * 600, 900)
+        self.assertEqual(self.occupancy.timer_length(1, 900, 12000), 1800)
+        self.assertEqual(self.occupancy.timer_length(1, 900, 12000, max_length=1200), 1200)
+        self.assertEqual(self.occupancy.timer_length(1, 900, 12000, max_length=600), 900)
+
+    def test_multiplier_is_capped(self):
+        for i in range(8):
+            self.occupancy.record_trigger(1, 10000 + i * 60, 1800)
+        self.assertEqual(self.occupancy.timer_length(1, 1800, 10500), 7200)
+
+    def test_flaps(self):
+        self.assertEqual(self.occupancy.record_trigger(1, 1000, 120), (False, False))
+        self.occupancy.record_off(1, 1120)
+        self.assertEqual(self.occupancy.record_trigger(1, 1150, 120), (True, True))
+        self.occupancy.record_off(1, 1270)
+        self.assertEqual(self.occupancy.record_trigger(1, 2000, 120), (False, False))
+        self.assertEqual(self.occupancy.dump(1)["flaps"], 1)
+        self.assertEqual(self.occupancy.dump(1)["baseline_flaps"], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,7 @@
+import clock
 import datetime
+import fake_redis
+import json
 import programs
 import unittest
 
@@ -7,7 +10,8 @@ class TestLightProgram(unittest.TestCase):
     def setUp(self):
         self.morning_program = programs.LightProgram("weekday", "morning", {"start_at": "08:15", "duration": 3600, "brightness": 100})
         self.evening_program = programs.LightProgram("weekday", "evening", {"start_at": "22:15", "duration": 1800})
-        self.lightprograms = programs.LightPrograms(force_defaults=False)
+        fake_redis.FakeCountingRedis.reset()
+        self.lightprograms = programs.LightPrograms(force_defaults=False, redis_class=fake_redis.FakeCountingRedis)
 
     def test_duration(self):
         now = datetime.datetime(2016, 3, 30, 8, 34, 5, 690085)
@@ -61,25 +65,22 @@ class TestLightPrograms(unittest.TestCase):
     def setUp(self):
         self.morning_program = programs.LightProgram("weekday", "morning", {"start_at": "08:15", "duration": 60, "brightness": 100})
         self.evening_program = programs.LightProgram("weekday", "evening", {"start_at": "22:15", "duration": 45})
-        self.lightprograms = programs.LightPrograms(force_defaults=True)
-
-    def test_get_day_programs(self):
-        morning, evening = self.lightprograms.get_day_programs(0)
-        self.assertIsNotNone(morning)
-        self.assertIsNotNone(evening)
-        self.assertEqual(morning.tod, "morning")
-        self.assertEqual(evening.tod, "evening")
-        self.assertEqual(morning.period, "weekday")
-        self.assertEqual(evening.period, "weekday")
-        morning, evening = self.lightprograms.get_day_programs(4)
-        self.assertEqual(morning.period, "weekday")
-        self.assertEqual(evening.period, "weekend")
-        morning, evening = self.lightprograms.get_day_programs(5)
-        self.assertEqual(morning.period, "weekend")
-        self.assertEqual(evening.period, "weekend")
-        morning, evening = self.lightprograms.get_day_programs(6)
-        self.assertEqual(morning.period, "weekend")
-        self.assertEqual(evening.period, "weekday")
+        fake_redis.FakeCountingRedis.reset()
+        self.lightprograms = programs.LightPrograms(force_defaults=True, redis_class=fake_redis.FakeCountingRedis)
+
+    def test_day_intervals(self):
+        program_schedule = self.lightprograms.get_schedule(datetime.datetime(2016, 3, 28, 12, 0))
+        for date, morning_period, evening_period in (
+                (datetime.date(2016, 3, 28), "weekday", "weekday"),
+                (datetime.date(2016, 4, 1), "weekday", "weekend"),
+                (datetime.date(2016, 4, 2), "weekend", "weekend"),
+                (datetime.date(2016, 4, 3), "weekend", "weekday")):
+            morning = program_schedule.day_interval(date, "morning")
+            evening = program_schedule.day_interval(date, "evening")
+            self.assertEqual(morning.program.tod, "morning")
+            self.assertEqual(evening.program.tod, "evening")
+            self.assertEqual(morning.program.period, morning_period)
+            self.assertEqual(evening.program.period, evening_period)
 
     def test_is_day_or_night(self):
         now = datetime.datetime(2016, 3, 30, 8, 34, 5, 690085)
@@ -102,6 +103,25 @@ class TestLightPrograms(unittest.TestCase):
         self.assertFalse(self.lightprograms.is_day(now))
         self.assertTrue(self.lightprograms.is_night(now))
 
+    def test_is_day_without_shared_programs(self):
+        self.lightprograms.redis.set("lightcontrol-program-morning-weekday", json.dumps({"start_at": "07:00", "duration": 3600, "groups": [1]}))
+        self.lightprograms.redis.incr("lightcontrol-programs-version")
+        # Default morning program is used for deciding between day and night
+        self.assertFalse(self.lightprograms.is_day(datetime.datetime(2016, 3, 30, 7, 30)))
+        self.assertTrue(self.lightprograms.is_day(datetime.datetime(2016, 3, 30, 8, 30)))
+        self.assertEqual(self.lightprograms.get_running_program(datetime.datetime(2016, 3, 30, 7, 30), 1).name, "morning-weekday")
+
+    def test_invalid_programs_are_skipped(self):
+        self.lightprograms.redis.sadd("lightcontrol-programs", "broken", "nostart")
+        self.lightprograms.redis.set("lightcontrol-program-broken", json.dumps({"start_at": "07:00", "duration": 3600}))
+        self.lightprograms.redis.set("lightcontrol-program-nostart", json.dumps({"tod": "morning", "duration": 3600}))
+        self.lightprograms.redis.incr("lightcontrol-programs-version")
+        now = datetime.datetime(2016, 3, 30, 8, 34, 5, 690085)
+        self.assertTrue(self.lightprograms.is_day(now))
+        self.assertEqual(self.lightprograms.get_running_program(now).name, "morning-weekday")
+        self.lightprograms.redis.srem("lightcontrol-programs", "broken", "nostart")
+        self.lightprograms.redis.delete("lightcontrol-program-broken", "lightcontrol-program-nostart")
+
     def test_timer_length(self):
         now = datetime.datetime(2016, 3, 30, 8, 34, 5, 690085)
         self.assertEqual(self.lightprograms.set_default_timer_length(now), 15)
@@ -119,6 +139,51 @@ class TestLightPrograms(unittest.TestCase):
         self.assertIsNone(data)
 
 
+class TestProgramTargets(unittest.TestCase):
+    def setUp(self):
+        self.now = datetime.datetime(2016, 3, 30, 22, 45)
+        fake_redis.FakeCountingRedis.reset()
+        self.lightprograms = programs.LightPrograms(force_defaults=True, redis_class=fake_redis.FakeCountingRedis, clock=clock.VirtualClock(self.now))
+        self.redis = self.lightprograms.redis
+        self.redis.set("lightprogram-evening-weekday-running", "true")
+        self.executed = []
+        execute_program = self.lightprograms.execute_program
+
+        def counting_execute_program(now, program, *args):
+            self.executed.append(program.name)
+            return execute_program(now, program, *args)
+        self.lightprograms.execute_program = counting_execute_program
+
+    def get_syncs(self):
+        return [json.loads(message) for message in fake_redis.FakeCountingRedis.published_on("lightcontrol-control-pubsub")]
+
+    def test_targets(self):
+        self.lightprograms.tick(self.now)
+        # Shared program is executed once for all groups
+        self.assertEqual(self.executed, ["evening-weekday"])
+        syncs = self.get_syncs()
+        self.assertEqual(len(syncs), 1)
+        self.assertEqual(syncs[0]["command"], "program-sync")
+        self.assertEqual(syncs[0]["targets"], dict((str(group_id), {"color": "white", "brightness": 50}) for group_id in range(1, 5)))
+        # Group None holds global defaults, and is not synced
+        self.assertEqual(self.redis.get("lightcontrol-default-brightness"), "50")
+        self.assertEqual(self.redis.get("lightcontrol-group-2-default-brightness"), "50")
+
+        self.lightprograms.tick(self.now)
+        self.assertEqual(len(self.get_syncs()), 1)
+
+        self.redis.sadd("lightcontrol-programs", "kitchen")
+        self.redis.set("lightcontrol-program-kitchen", json.dumps({"tod": "evening", "start_at": "22:00", "duration": 7200, "groups": [3], "brightness_curve": [[0, 30], [1, 30]]}))
+        self.redis.set("lightprogram-kitchen-running", "true")
+        self.redis.incr("lightcontrol-programs-version")
+        self.lightprograms.tick(self.now)
+        syncs = self.get_syncs()
+        self.assertEqual(len(syncs), 2)
+        self.assertEqual(syncs[1]["targets"], {"3": {"color": "white", "brightness": 30}})
+        self.assertEqual(self.redis.get("lightcontrol-group-3-default-brightness"), "30")
+        self.assertEqual(self.redis.get("lightcontrol-default-brightness"), "50")
+
+
 class TestRunningMorning(unittest.TestCase):
     pass
 
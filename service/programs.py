@@ -1,36 +1,141 @@
 """Light programs - scheduled programs
 
 Usage:
-    programs.py run [--debug] [--redis-host=<hostname>] [--redis-port=<port>]
+    programs.py run [--debug] [--redis-host=<hostname>] [--redis-port=<port>] [--stats-port=<port>]
 
+Program names are listed in lightcontrol-programs, with program data in
+lightcontrol-program-<name>. Holidays (YYYY-MM-DD) are listed in
+lightcontrol-holidays. After changing programs or holidays, INCR
+lightcontrol-programs-version to have services recompile their schedules.
 """
 
 import datetime
+import clock
 import docopt
+import health
 import multiprocessing
 import os
-import redis
+import schedule
+import stats
 import threading
 import time
 import logging
 import json
 
 
+DEFAULT_PROGRAMS = {
+    "morning-weekday": {
+        "start_at": "08:15",
+        "duration": 3600,
+        "brightness": 100,
+        "days": [0, 1, 2, 3, 4],
+    },
+    "morning-weekend": {
+        "start_at": "09:30",
+        "duration": 3600,
+        "brightness": 100,
+        "days": [5, 6],
+    },
+    "evening-weekday": {
+        "start_at": "22:30",
+        "duration": 1800,
+        "days": [0, 1, 2, 3, 6],
+    },
+    "evening-weekend": {
+        "start_at": "23:00",
+        "duration": 1800,
+        "days": [4, 5],
+    },
+}
+
+# Evening programs without a brightness curve dim lights from 100% to 0%.
+DEFAULT_EVENING_CURVE = [[0, 100], [1, 0]]
+
+PROGRAMS_VERSION_KEY = "lightcontrol-programs-version"
+
+
+def get_default_day_program(tod, weekday):
+    """ Returns default tod ("morning" or "evening") program running on weekday """
+    for name, data in sorted(DEFAULT_PROGRAMS.items()):
+        program = LightProgram.from_data(name, data)
+        if program.tod == tod and weekday in program.days:
+            return program
+
+
 class LightProgram(object):
-    def __init__(self, period, tod, data):
+    """ A single scheduled program.
+
+    In addition to start_at and duration, program data may contain
+    - days: list of weekdays (0=Monday) the program runs on
+    - groups: list of group IDs the program applies to (default: all groups)
+    - brightness_curve: [[fraction done, brightness], ...], interpolated linearly
+    - color: color name, or [[fraction done, color], ...] steps
+    - priority: when programs overlap, the highest priority wins (default 0)
+    - holidays: "include" (default), "skip" or "only"
+    """
+
+    def __init__(self, period, tod, data, name=None):
         self.start_at = data["start_at"]
+        self.start_at_time = datetime.datetime.strptime(self.start_at, "%H:%M").time()
         self.duration = data["duration"]
         self.brightness = data.get("brightness")
         self.period = period
         self.tod = tod
+        self.name = name or "%s-%s" % (tod, period)
+        self.days = tuple(data.get("days", DEFAULT_PROGRAMS.get(self.name, {}).get("days", range(7))))
+        self.groups = data.get("groups")
+        self.brightness_curve = data.get("brightness_curve")
+        self.color = data.get("color")
+        self.priority = data.get("priority", 0)
+        self.holidays = data.get("holidays", "include")
+
+    @classmethod
+    def from_data(cls, name, data):
+        """ Programs named <tod>-<period> do not need tod in data """
+        if "tod" in data:
+            return cls(data.get("period", name), data["tod"], data, name)
+        if "-" not in name:
+            raise ValueError("Program %s has no tod, and its name is not <tod>-<period>" % name)
+        tod, period = name.split("-", 1)
+        return cls(period, tod, data, name)
 
     def dump(self):
         return {
             "start_at": self.start_at,
             "duration": self.duration,
             "brightness": self.brightness,
+            "tod": self.tod,
+            "days": list(self.days),
+            "groups": self.groups,
+            "brightness_curve": self.brightness_curve,
+            "color": self.color,
+            "priority": self.priority,
+            "holidays": self.holidays,
         }
 
+    def brightness_at(self, done):
+        curve = self.brightness_curve
+        if curve is None:
+            if self.tod != "evening":
+                return self.brightness
+            curve = DEFAULT_EVENING_CURVE
+        if done <= curve[0][0]:
+            return curve[0][1]
+        for (start, start_value), (end, end_value) in zip(curve, curve[1:]):
+            if done <= end:
+                return int(start_value + (end_value - start_value) * (done - start) / float(end - start))
+        return curve[-1][1]
+
+    def color_at(self, done):
+        if not isinstance(self.color, list):
+            return self.color
+        color = None
+        for start, step_color in self.color:
+            if done < start:
+                break
+            color = step_color
+        return color
+
     @classmethod
     def calc_days_to(cls, current_day, dest_days):
         for p in range(0, 7):
@@ -41,8 +146,7 @@ class LightProgram(object):
     def get_start_end(self, now, advance=True):
         date = now.date()
         weekday = now.weekday()
-        start_at_time = datetime.datetime.strptime(self.start_at, "%H:%M").time()
-        start_at_datetime = datetime.datetime.combine(date, start_at_time)
+        start_at_datetime = datetime.datetime.combine(date, self.start_at_time)
         end_at_datetime = start_at_datetime + datetime.timedelta(seconds=self.duration)
         next_occurance = None
         if advance:
@@ -52,16 +156,7 @@ class LightProgram(object):
                 not_today = True
             else:
                 not_today = False
-            if self.tod == "morning":
-                if self.period == "weekend":
-                    plus_days = self.calc_days_to(weekday, (5, 6))
-                else:  # weekday
-                    plus_days = self.calc_days_to(weekday, (0, 1, 2, 3, 4))
-            else:  # evening
-                if self.period == "weekend":
-                    plus_days = self.calc_days_to(weekday, (4, 5))
-                else:  # weekday
-                    plus_days = self.calc_days_to(weekday, (0, 1, 2, 3, 6))
+            plus_days = self.calc_days_to(weekday, self.days)
             if not_today:
                 plus_days += 1
             start_at_datetime += datetime.timedelta(days=plus_days)
@@ -83,17 +178,18 @@ class LightProgram(object):
         return (now - start).total_seconds() / (self.duration)
 
     def __repr__(self):
-        return u"LightProgram<%s-%s: %s+%ss, brightness=%s>" % (self.tod, self.period, self.start_at, self.duration, self.brightness)
+        return u"LightProgram<%s (%s): %s+%ss, brightness=%s>" % (self.name, self.tod, self.start_at, self.duration, self.brightness)
 
 
 class LightPrograms(object):
     def __init__(self, **kwargs):
+        self.stats = kwargs.get("stats") or stats.ServiceStats("programs")
         redis_args = {}
         if "redis_host" in kwargs and kwargs["redis_host"]:
             redis_args["host"] = kwargs["redis_host"]
         if "redis_port" in kwargs and kwargs["redis_port"]:
             redis_args["port"] = kwargs["redis_port"]
-        self.redis = redis.StrictRedis(**redis_args)
+        self.redis = kwargs.get("redis_class", stats.CountingStrictRedis)(self.stats, **redis_args)
 
         self.logger = logging.getLogger("lightcontrol-control")
         if kwargs.get("debug"):
@@ -105,72 +201,121 @@ class LightPrograms(object):
         ch = logging.StreamHandler()
         ch.setFormatter(formatter)
         self.logger.addHandler(ch)
+        self.clock = kwargs.get("clock") or clock.SystemClock()
+        self.schedule = None
+        self.schedule_fingerprint = None
+        self.schedule_version = None
+        self.schedule_verified_at = 0
+        self.verify_interval = 60
+        self.group_ids = kwargs.get("group_ids") or range(1, 5)
+        self.applied_targets = {}
+        self.heartbeat = health.Heartbeat("programs", self.redis, interval=20)
+        self.backpressure = health.Backpressure(self.redis)
         self.set_default_programs(kwargs.get("force_defaults", False))
 
     def set_default_programs(self, force=False):
-        default_programs = {
-            "morning-weekday": {
-                "start_at": "08:15",
-                "duration": 3600,
-                "brightness": 100,
-            },
-            "morning-weekend": {
-                "start_at": "09:30",
-                "duration": 3600,
-                "brightness": 100,
-            },
-            "evening-weekday": {
-                "start_at": "22:30",
-                "duration": 1800,
-            },
-            "evening-weekend": {
-                "start_at": "23:00",
-                "duration": 1800,
-            },
-        }
-        for program, details in default_programs.items():
+        for program, details in DEFAULT_PROGRAMS.items():
+            self.redis.sadd("lightcontrol-programs", program)
             if not force:
                 if self.redis.exists("lightcontrol-program-%s" % program):
                     self.logger.debug("Skip setting %s - already exists and force is not enabled", program)
                     continue
             self.logger.info("Setting %s to defaults: %s.", program, details)
             self.redis.set("lightcontrol-program-%s" % program, json.dumps(details))
-
-    def create_morning_program_timer(self, length, **kwargs):
+            self.redis.incr(PROGRAMS_VERSION_KEY)
+
+    def fetch_programs(self):
+        """ Returns program names, raw program data and holidays from redis """
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.smembers("lightcontrol-programs")
+        pipe.smembers("lightcontrol-holidays")
+        names, holidays = pipe.execute()
+        names = sorted(names)
+        if names:
+            values = self.redis.mget(["lightcontrol-program-%s" % name for name in names])
+        else:
+            values = []
+        return names, values, holidays
+
+    def parse_programs(self, names, values):
+        programs = []
+        for name, value in zip(names, values):
+            if value is None:
+                self.logger.warning("Program %s is listed in lightcontrol-programs, but lightcontrol-program-%s does not exist", name, name)
+                continue
+            try:
+                programs.append(LightProgram.from_data(name, json.loads(value)))
+            except (ValueError, KeyError, TypeError, AttributeError) as err:
+                self.logger.warning("Skipping invalid program %s: %s (%s)", name, err, value)
+                continue
+        return programs
+
+    def get_schedule(self, now, verify=False):
+        """ Returns compiled schedule covering now.
+
+        Usually this costs a single GET of lightcontrol-programs-version. Programs and holidays are
+        fetched and compared only when the version or the date changes, with verify=True (once per tick),
+        or every verify_interval seconds, so changes made without bumping the version are picked up too.
+        """
+        version = self.redis.get(PROGRAMS_VERSION_KEY)
+        checked_at = self.clock.time()
+        if (not verify and self.schedule is not None and version == self.schedule_version and
+                now.date() == self.schedule.start.date() and checked_at - self.schedule_verified_at < self.verify_interval):
+            return self.schedule
+        self.schedule_version = version
+        self.schedule_verified_at = checked_at
+        names, values, holidays = self.fetch_programs()
+        fingerprint = (tuple(names), tuple(values), frozenset(holidays), now.date())
+        if fingerprint != self.schedule_fingerprint:
+            holiday_dates = [datetime.datetime.strptime(holiday, "%Y-%m-%d").date() for holiday in holidays]
+            self.logger.debug("Compiling schedule for %s programs and %s holidays", len(names), len(holiday_dates))
+            self.schedule = schedule.ProgramSchedule(self.parse_programs(names, values), holiday_dates, now.date())
+            self.schedule_fingerprint = fingerprint
+        return self.schedule
+
+    def create_morning_program_timer(self, length, groups=None, **kwargs):
         self.logger.info("Setting morning timer: %ss", length)
-        data = {
-            "group": 0,
-            "duration": length
-        }
-        data.update(kwargs)
-        self.redis.publish("lightcontrol-timer-pubsub", json.dumps(data))
+        for group_id in groups or (0,):
+            data = {
+                "group": group_id,
+                "duration": length
+            }
+            data.update(kwargs)
+            self.redis.publish("lightcontrol-timer-pubsub", json.dumps(data))
 
     def refresh_program_timestamp(self, now):
-        for program_period, program_tod in (("weekend", "morning"), ("weekend", "evening"), ("weekday", "morning"), ("weekday", "evening")):
-            redis_key = "lightcontrol-program-%s-%s" % (program_tod, program_period)
-            program = LightProgram(program_period, program_tod, json.loads(self.redis.get(redis_key)))
-            self.redis.set("%s-next_start_at" % redis_key, program.start_datetime(now).isoformat())
-            self.redis.set("%s-next_end_at" % redis_key, program.end_datetime(now).isoformat())
-
-    def get_day_programs(self, weekday):
-        morning_program = evening_program = "weekday"
-        if weekday == 4:  # Friday
-            evening_program = "weekend"
-        if weekday == 5:  # Saturday
-            morning_program = evening_program = "weekend"
-        if weekday == 6:  # Sunday
-            morning_program = "weekend"
-        morning = json.loads(self.redis.get("lightcontrol-program-morning-%s" % morning_program))
-        evening = json.loads(self.redis.get("lightcontrol-program-evening-%s" % evening_program))
-        return LightProgram(morning_program, "morning", morning), LightProgram(evening_program, "evening", evening)
+        program_schedule = self.get_schedule(now)
+        timestamps = {}
+        for program in program_schedule.programs:
+            interval = program_schedule.next_interval(program.name, now)
+            if interval is None:
+                continue
+            redis_key = "lightcontrol-program-%s" % program.name
+            timestamps["%s-next_start_at" % redis_key] = interval.start.isoformat()
+            timestamps["%s-next_end_at" % redis_key] = interval.end.isoformat()
+        if timestamps:
+            self.redis.mset(timestamps)
 
+    @stats.timed("is_day")
     def is_day(self, now):
+        """ Day lasts from the start of the morning program to the end of the evening program.
+
+        Programs come from the compiled schedule. Default programs are used when no shared
+        morning or evening program runs on the day.
+        """
         assert isinstance(now, datetime.datetime)
-        weekday = now.weekday()
-        morning, evening = self.get_day_programs(weekday)
-        morning_start = morning.start_datetime(now, False)
-        evening_start = evening.start_datetime(now)
-        evening_end = evening.end_datetime(now, False)
+        program_schedule = self.get_schedule(now)
+        date = now.date()
+        morning = program_schedule.day_interval(date, "morning")
+        if morning is None:
+            morning_start = get_default_day_program("morning", date.weekday()).start_datetime(now, False)
+        else:
+            morning_start = morning.start
+        evening = program_schedule.day_interval(date, "evening")
+        if evening is None:
+            evening_end = get_default_day_program("evening", date.weekday()).end_datetime(now, False)
+        else:
+            evening_end = evening.end
         if now > evening_end or now < morning_start:
             return False
         return True
@@ -186,39 +331,65 @@ class LightPrograms(object):
             return True
         return False
 
-    def get_running_program(self, now):
+    @stats.timed("get_running_program")
+    def get_running_interval(self, now, group_id=None):
+        """ Returns schedule.ProgramInterval running for group_id, or for all groups if group_id is None. """
         assert isinstance(now, datetime.datetime)
-        weekday = now.weekday()
-        morning, evening = self.get_day_programs(weekday)
-        for program in morning, evening:
-            running = self.is_program_running(now, program)
-            if running:
-                self.logger.debug("Program %s is currently running", program)
-                return program
+        interval = self.get_schedule(now).lookup(group_id, now)
+        if interval is not None:
+            self.logger.debug("Program %s is currently running", interval.program)
+        return interval
+
+    def get_running_program(self, now, group_id=None):
+        interval = self.get_running_interval(now, group_id)
+        if interval is not None:
+            return interval.program
 
     def set_default_timer_length(self, now):
         assert isinstance(now, datetime.datetime)
         if self.is_day(now):
             timer = 15 * 60
+            max_timer = 60 * 60
         else:
             timer = 2 * 60
-        self.redis.set("lightcontrol-timer-length", timer)
+            max_timer = 10 * 60
+        # Timers service scales timer length with occupancy, up to max_timer.
+        self.redis.mset({"lightcontrol-timer-length": timer, "lightcontrol-timer-max-length": max_timer})
         return timer
 
-    def execute_program(self, now, program):
+    def get_default_target(self, night):
+        if night:
+            return {"color": "red", "brightness": 0, "sync": False}
+        return {"color": "white", "brightness": 100, "sync": False}
+
+    def execute_program(self, now, program, done=None, night=None):
+        """ Runs program actions and returns target for groups the program applies to.
+
+        Returns None if the program is marked as non-running. Evening program targets
+        are marked to be synced to groups that are already on.
+        """
         assert isinstance(now, datetime.datetime)
         assert isinstance(program, LightProgram)
 
-        if self.redis.get("lightprogram-%s-%s-running" % (program.tod, program.period)) not in ("true", "True"):
+        if self.redis.get("lightprogram-%s-running" % program.name) not in ("true", "True"):
             self.logger.debug("Skipping program %s, as it is marked as non-running", program)
             return
 
-        if program.brightness is not None:
-            self.redis.set("lightcontrol-default-brightness", program.brightness)
-        if self.is_night(now):
-            self.redis.set("lightcontrol-default-color", "red")
+        if night is None:
+            night = self.is_night(now)
+        target = self.get_default_target(night)
+        if done is None:
+            done = program.percent_done(now)
+        if done is None:
+            brightness = program.brightness
+            color = None
         else:
-            self.redis.set("lightcontrol-default-color", "white")
+            brightness = program.brightness_at(done)
+            color = program.color_at(done)
+        if brightness is not None:
+            target["brightness"] = brightness
+        if color is not None:
+            target["color"] = color
         # Morning programs
         if program.tod == "morning":
             program_triggered_key = "lightprogram-%s-%s-triggered" % (program.period, program.tod)
@@ -227,41 +398,87 @@ class LightPrograms(object):
                 program_triggered = json.loads(program_triggered)
                 if program_triggered["duration"] == program.duration and program_triggered["start_at"] == program.start_at:
                     self.logger.debug("Morning program %s (%s) has already been activated.", program.tod, program.period)
-                    return
+                    return target
                 else:
                     self.logger.debug("Morning program details (%s, %s) changed - reactivate timer.", program.tod, program.period)
-            self.create_morning_program_timer(program.duration, force=True)
+            self.create_morning_program_timer(program.duration, program.groups, force=True)
             self.redis.setex(program_triggered_key, program.duration + 10, json.dumps(program.dump()))
-            return
+            return target
         # Evening programs
         # TODO: do not brighten lights
-        done = program.percent_done(now)
         if done is None:
             self.logger.warning("Tried to execute %s (%s) but percent_done returned None.", program.tod, program.period)
-            return
-        brightness = int((1 - done) * 100)
-        self.logger.debug("Program %s (%s) - setting brightness to %s", program.tod, program.period, brightness)
-        self.redis.set("lightcontrol-default-brightness", brightness)
-        self.redis.publish("lightcontrol-control-pubsub", json.dumps({"command": "program-sync", "group": 0, "source": "program"}))
+            return target
+        self.logger.debug("Program %s (%s) - setting brightness to %s", program.tod, program.period, target["brightness"])
+        target["sync"] = True
+        return target
+
+    def get_group_targets(self, now):
+        """ Returns {group_id: target} for all groups. Group None holds the target for programs shared by all groups. """
+        night = self.is_night(now)
+        program_targets = {}
+        targets = {}
+        for group_id in [None] + list(self.group_ids):
+            interval = self.get_running_interval(now, group_id)
+            target = None
+            if interval is not None:
+                program = interval.program
+                # Each program is executed only once, even if it applies to multiple groups.
+                if program.name not in program_targets:
+                    program_targets[program.name] = self.execute_program(now, program, interval.percent_done(now), night)
+                target = program_targets[program.name]
+            if target is None:
+                target = self.get_default_target(night)
+            targets[group_id] = target
+        return targets
+
+    def apply_targets(self, targets):
+        """ Stores changed targets as defaults, and sends a single program-sync for changed groups """
+        defaults = {}
+        sync_targets = {}
+        shed_sync = self.backpressure.active()
+        for group_id, target in targets.items():
+            applied = self.applied_targets.get(group_id)
+            if applied is not None and applied["color"] == target["color"] and applied["brightness"] == target["brightness"]:
+                continue
+            if shed_sync and target["sync"] and group_id is not None:
+                # Control is lagging. Group is not marked as applied, so the latest target is synced on a later tick.
+                self.stats.incr("backpressure:shed")
+                continue
+            if group_id is None:
+                redis_key = "lightcontrol-default"
+            else:
+                redis_key = "lightcontrol-group-%s-default" % group_id
+            defaults["%s-color" % redis_key] = target["color"]
+            defaults["%s-brightness" % redis_key] = target["brightness"]
+            if target["sync"] and group_id is not None:
+                sync_targets[group_id] = {"color": target["color"], "brightness": target["brightness"]}
+            self.applied_targets[group_id] = target
+        if defaults:
+            self.redis.mset(defaults)
+        if sync_targets:
+            self.logger.debug("Syncing program targets: %s", sync_targets)
+            self.redis.publish("lightcontrol-control-pubsub", json.dumps({"command": "program-sync", "group": 0, "source": "program", "targets": sync_targets}))
+        return sync_targets
+
+    def tick(self, now):
+        self.get_schedule(now, verify=True)
+        self.refresh_program_timestamp(now)
+        self.set_default_timer_length(now)
+        self.apply_targets(self.get_group_targets(now))
 
     def run(self):
         while True:
-            now = datetime.datetime.now()
-            self.refresh_program_timestamp(now)
-            program = self.get_running_program(now)
-            if not program:
-                self.set_default_timer_length(now)
-                if self.is_night(now):
-                    self.redis.set("lightcontrol-default-color", "red")
-                    self.redis.set("lightcontrol-default-brightness", 0)
-                else:
-                    self.redis.set("lightcontrol-default-color", "white")
-                    self.redis.set("lightcontrol-default-brightness", 100)
-                time.sleep(20)
-                continue
-            self.set_default_timer_length(now)
-            self.execute_program(now, program)
-            time.sleep(20)
+            started_at = time.time()
+            try:
+                self.tick(self.clock.now())
+            except Exception:
+                self.stats.incr("errors")
+                self.logger.exception("Executing programs failed")
+            else:
+                # Programs have no message loop - lag is the time spent on a single tick.
+                self.heartbeat.report(time.time() - started_at)
+            self.clock.sleep(20)
 
 
 def main(args):
@@ -270,6 +487,8 @@ def main(args):
         "redis_port": args.get("--redis-post"),
     }
     light_programs = LightPrograms(debug=args.get("--debug", False), **kwargs)
+    if args.get("--stats-port"):
+        stats.start_server(light_programs.stats, args["--stats-port"])
     light_programs.run()
 
 
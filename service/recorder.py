@@ -0,0 +1,440 @@
+"""Light recorder - records light state and trigger history
+
+Usage:
+    recorder.py run <data-dir> [--debug] [--redis-host=<hostname>] [--redis-port=<port>] [--stats-port=<port>]
+    recorder.py query <data-dir> <start> <end> [--watts=<watts>]
+
+Events are stored in one directory per day (<data-dir>/YYYY-MM-DD), with one
+file per field. Each file is an array of fixed-width values, so the n:th event
+is the n:th value in each of the files. Sensor names and colors are stored as
+codes, listed in <data-dir>/dictionary.json.
+
+Once a day is complete, per-group totals are stored to summary.json in the
+day directory. Queries read summaries for full days, and scan events only
+for partial days at the start and the end of the range.
+"""
+
+import array
+import datetime
+import docopt
+import health
+import json
+import logging
+import mmap
+import os
+import stats
+import threading
+import time
+
+COLUMNS = (
+    ("ts", "d"),
+    ("kind", "B"),
+    ("group", "B"),
+    ("value", "i"),
+    ("color", "B"),
+)
+
+KIND_SENSOR = 1  # value: sensor code
+KIND_TRIGGER = 2  # timer refreshed by a trigger
+KIND_TIMER = 3  # timer with explicit duration. value: duration
+KIND_ON = 4  # value: brightness (-1 if unknown), color: color code
+KIND_OFF = 5
+
+GROUP_IDS = range(1, 5)
+
+
+def read_column(filename, typecode):
+    """ Returns memory-mapped column, or an empty array if it does not exist """
+    if not os.path.exists(filename) or os.path.getsize(filename) == 0:
+        return array.array(typecode)
+    with open(filename, "rb") as column_file:
+        column_map = mmap.mmap(column_file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return memoryview(column_map).cast(typecode)
+    except AttributeError:  # Python 2
+        column = array.array(typecode)
+        column.fromstring(column_map[:])
+        return column
+
+
+class ChunkDictionary(object):
+    def __init__(self, data_dir):
+        self.filename = os.path.join(data_dir, "dictionary.json")
+        self.lock = threading.Lock()
+        self.values = []
+        if os.path.exists(self.filename):
+            with open(self.filename) as dictionary_file:
+                self.values = json.load(dictionary_file)
+        self.codes = dict((value, i + 1) for i, value in enumerate(self.values))
+
+    def get_code(self, value):
+        if value is None:
+            return 0
+        with self.lock:
+            if value not in self.codes:
+                self.values.append(value)
+                self.codes[value] = len(self.values)
+                with open(self.filename + ".tmp", "w") as dictionary_file:
+                    json.dump(self.values, dictionary_file)
+                os.rename(self.filename + ".tmp", self.filename)
+            return self.codes[value]
+
+    def get_value(self, code):
+        if code == 0:
+            return None
+        return self.values[code - 1]
+
+
+class ChunkWriter(object):
+    def __init__(self, data_dir, flush_interval=5, flush_events=256):
+        self.data_dir = data_dir
+        self.flush_interval = flush_interval
+        self.flush_events = flush_events
+        self.lock = threading.Lock()
+        self.buffers = dict((name, array.array(typecode)) for name, typecode in COLUMNS)
+        self.buffer_date = None
+        self.flushed_at = time.time()
+        self.completed_dates = []
+
+    def chunk_dir(self, date):
+        return os.path.join(self.data_dir, date.isoformat())
+
+    def append(self, timestamp, kind, group_id, value=0, color=0):
+        date = datetime.datetime.fromtimestamp(timestamp).date()
+        with self.lock:
+            if self.buffer_date is not None and date != self.buffer_date:
+                self.flush_buffers()
+                self.completed_dates.append(self.buffer_date)
+            self.buffer_date = date
+            for (name, _), item in zip(COLUMNS, (timestamp, kind, group_id, value, color)):
+                self.buffers[name].append(item)
+            if len(self.buffers["ts"]) >= self.flush_events or time.time() - self.flushed_at > self.flush_interval:
+                self.flush_buffers()
+
+    def flush(self):
+        with self.lock:
+            self.flush_buffers()
+
+    def flush_buffers(self):
+        self.flushed_at = time.time()
+        if not self.buffers["ts"]:
+            return
+        chunk_dir = self.chunk_dir(self.buffer_date)
+        if not os.path.exists(chunk_dir):
+            os.makedirs(chunk_dir)
+        for name, typecode in COLUMNS:
+            with open(os.path.join(chunk_dir, "%s.col" % name), "ab") as column_file:
+                self.buffers[name].tofile(column_file)
+            self.buffers[name] = array.array(typecode)
+
+    def pop_completed_dates(self):
+        with self.lock:
+            completed_dates, self.completed_dates = self.completed_dates, []
+            return completed_dates
+
+
+class GroupTotals(object):
+    def __init__(self):
+        self.on_seconds = 0.0
+        self.brightness_seconds = 0.0
+        self.triggers = 0
+
+    def add(self, other):
+        self.on_seconds += other.on_seconds
+        self.brightness_seconds += other.brightness_seconds
+        self.triggers += other.triggers
+
+    def dump(self):
+        return {
+            "on_seconds": self.on_seconds,
+            "brightness_seconds": self.brightness_seconds,
+            "triggers": self.triggers,
+        }
+
+    @classmethod
+    def load(cls, data):
+        totals = cls()
+        totals.on_seconds = data["on_seconds"]
+        totals.brightness_seconds = data["brightness_seconds"]
+        totals.triggers = data["triggers"]
+        return totals
+
+
+class HistoryReader(object):
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.dictionary = ChunkDictionary(data_dir)
+
+    def chunk_dir(self, date):
+        return os.path.join(self.data_dir, date.isoformat())
+
+    def read_chunk(self, date):
+        chunk_dir = self.chunk_dir(date)
+        columns = dict((name, read_column(os.path.join(chunk_dir, "%s.col" % name), typecode)) for name, typecode in COLUMNS)
+        # Columns may have different lengths if writing was interrupted
+        length = min(len(column) for column in columns.values())
+        return dict((name, column[:length]) for name, column in columns.items())
+
+    def scan(self, date, start, end, state):
+        """ Returns {group_id: GroupTotals} for events between start and end (timestamps) on date.
+
+        state is {group_id: brightness of lights that are on}, and is updated to the state at end.
+        """
+        totals = dict((group_id, GroupTotals()) for group_id in GROUP_IDS)
+        since = dict((group_id, start) for group_id in state)
+        chunk = self.read_chunk(date)
+        timestamps, kinds, groups, values = chunk["ts"], chunk["kind"], chunk["group"], chunk["value"]
+        for i in range(len(timestamps)):
+            timestamp = timestamps[i]
+            if timestamp < start:
+                kind = kinds[i]
+                if kind == KIND_ON:
+                    state[groups[i]] = values[i]
+                elif kind == KIND_OFF:
+                    state.pop(groups[i], None)
+                continue
+            if timestamp >= end:
+                break
+            kind = kinds[i]
+            group_id = groups[i]
+            if group_id not in totals:
+                continue
+            if kind == KIND_TRIGGER:
+                totals[group_id].triggers += 1
+            elif kind in (KIND_ON, KIND_OFF):
+                if group_id in state:
+                    self.add_on_time(totals[group_id], state[group_id], timestamp - since.get(group_id, start))
+                if kind == KIND_ON:
+                    state[group_id] = values[i]
+                    since[group_id] = timestamp
+                else:
+                    state.pop(group_id, None)
+        for group_id, brightness in state.items():
+            if group_id in totals:
+                self.add_on_time(totals[group_id], brightness, end - since.get(group_id, start))
+        return totals
+
+    @classmethod
+    def add_on_time(cls, totals, brightness, seconds):
+        totals.on_seconds += seconds
+        if brightness < 0:
+            brightness = 100
+        totals.brightness_seconds += seconds * brightness / 100.0
+
+    @classmethod
+    def day_bounds(cls, date):
+        start = datetime.datetime.combine(date, datetime.time())
+        end = start + datetime.timedelta(days=1)
+        return time.mktime(start.timetuple()), time.mktime(end.timetuple())
+
+    def summary_filename(self, date):
+        return os.path.join(self.chunk_dir(date), "summary.json")
+
+    def recorded_dates(self):
+        """ Returns sorted dates that have a chunk directory """
+        dates = []
+        if not os.path.exists(self.data_dir):
+            return dates
+        for name in os.listdir(self.data_dir):
+            try:
+                dates.append(datetime.datetime.strptime(name, "%Y-%m-%d").date())
+            except ValueError:
+                continue
+        return sorted(dates)
+
+    def get_summary(self, date, start_state=None):
+        """ Returns (totals, state at the end of the day) for a complete day. Summaries are cached to summary.json.
+
+        start_state is the state at the start of the day. If not given, it is carried over from earlier days.
+        """
+        summary_filename = self.summary_filename(date)
+        if os.path.exists(summary_filename):
+            with open(summary_filename) as summary_file:
+                summary = json.load(summary_file)
+            totals = dict((int(group_id), GroupTotals.load(data)) for group_id, data in summary["groups"].items())
+            return totals, dict((int(group_id), brightness) for group_id, brightness in summary["end_state"].items())
+        if start_state is None:
+            start_state = self.get_start_state(date)
+        state = dict(start_state)
+        start, end = self.day_bounds(date)
+        totals = self.scan(date, start, end, state)
+        if os.path.exists(self.chunk_dir(date)) and date < datetime.date.today():
+            summary = {
+                "groups": dict((group_id, group_totals.dump()) for group_id, group_totals in totals.items()),
+                "end_state": state,
+            }
+            with open(summary_filename + ".tmp", "w") as summary_file:
+                json.dump(summary, summary_file)
+            os.rename(summary_filename + ".tmp", summary_filename)
+        return totals, state
+
+    def get_start_state(self, date):
+        """ Returns state at the start of the day, carried over from the latest recorded day before it.
+
+        Days without events keep the state unchanged. Recorded days without a summary are summarized
+        in order, starting from the latest summarized day (or from the first recorded day).
+        """
+        recorded = [recorded_date for recorded_date in self.recorded_dates() if recorded_date < date]
+        position = len(recorded)
+        while position > 0 and not os.path.exists(self.summary_filename(recorded[position - 1])):
+            position -= 1
+        state = {}
+        for recorded_date in recorded[max(position - 1, 0):]:
+            state = self.get_summary(recorded_date, state)[1]
+        return dict(state)
+
+    def query(self, start, end):
+        """ Returns {group_id: GroupTotals} between start and end datetimes """
+        totals = dict((group_id, GroupTotals()) for group_id in GROUP_IDS)
+        date = start.date()
+        start_timestamp = time.mktime(start.timetuple())
+        end_timestamp = time.mktime(end.timetuple())
+        # State is carried from day to day, including days without any events.
+        state = self.get_start_state(date)
+        while date <= end.date():
+            day_start, day_end = self.day_bounds(date)
+            if start_timestamp <= day_start and day_end <= end_timestamp and date < datetime.date.today():
+                day_totals, state = self.get_summary(date, state)
+            elif start_timestamp < day_end and day_start < end_timestamp:
+                day_totals = self.scan(date, max(start_timestamp, day_start), min(end_timestamp, day_end), state)
+            else:
+                day_totals = {}
+            for group_id, group_totals in day_totals.items():
+                if group_id in totals:
+                    totals[group_id].add(group_totals)
+            date += datetime.timedelta(days=1)
+        return totals
+
+    def report(self, start, end, watts=6.0):
+        """ Returns on time, trigger rate (per hour) and energy estimate (Wh, scaled by brightness) per group """
+        hours = (end - start).total_seconds() / 3600.0
+        report = {}
+        for group_id, group_totals in self.query(start, end).items():
+            report[group_id] = {
+                "on_seconds": group_totals.on_seconds,
+                "triggers": group_totals.triggers,
+                "trigger_rate": group_totals.triggers / hours if hours > 0 else 0,
+                "energy_wh": group_totals.brightness_seconds * watts / 3600.0,
+            }
+        return report
+
+
+class LightRecorder(object):
+    def __init__(self, data_dir, **kwargs):
+        self.stats = stats.ServiceStats("recorder")
+        redis_args = {}
+        if "redis_host" in kwargs and kwargs["redis_host"]:
+            redis_args["host"] = kwargs["redis_host"]
+        if "redis_port" in kwargs and kwargs["redis_port"]:
+            redis_args["port"] = kwargs["redis_port"]
+        self.redis = stats.CountingStrictRedis(self.stats, **redis_args)
+        if not os.path.exists(data_dir):
+            os.makedirs(data_dir)
+        self.writer = ChunkWriter(data_dir)
+        self.reader = HistoryReader(data_dir)
+        self.dictionary = self.reader.dictionary
+        self.group_states = {}
+        self.heartbeat = health.Heartbeat("recorder", self.redis, "lightcontrol-recorder-pubsub")
+
+        self.logger = logging.getLogger("lightcontrol-recorder")
+        if kwargs.get("debug"):
+            self.logger.setLevel(logging.DEBUG)
+        else:
+            self.logger.setLevel(logging.INFO)
+        format_string = "%(asctime)s - %(levelname)s - %(message)s"
+        formatter = logging.Formatter(format_string)
+        ch = logging.StreamHandler()
+        ch.setFormatter(formatter)
+        self.logger.addHandler(ch)
+
+    def record(self, timestamp, kind, group_id, value=0, color=0):
+        self.stats.incr("recorder:events")
+        self.writer.append(timestamp, kind, group_id, value, color)
+
+    def record_trigger(self, timestamp, data):
+        self.record(timestamp, KIND_SENSOR, 0, self.dictionary.get_code(data.get("key")))
+
+    def record_timer(self, timestamp, data):
+        group_id = data.get("group")
+        if group_id == 0:
+            group_ids = GROUP_IDS
+        else:
+            group_ids = [group_id]
+        for group_id in group_ids:
+            if data.get("duration") is None:
+                self.record(timestamp, KIND_TRIGGER, group_id)
+            else:
+                self.record(timestamp, KIND_TIMER, group_id, int(data["duration"]))
+
+    def record_broadcast(self, timestamp, data):
+        if data.get("key") != "lightcontrol":
+            return
+        for group in data.get("content", {}).get("groups", []):
+            if group.get("on"):
+                brightness = group.get("current_brightness")
+                if brightness is None:
+                    brightness = -1
+                state = (KIND_ON, int(brightness), self.dictionary.get_code(group.get("color")))
+            else:
+                state = (KIND_OFF, 0, 0)
+            if self.group_states.get(group["id"]) == state:
+                # Only changes are recorded
+                continue
+            self.group_states[group["id"]] = state
+            self.record(timestamp, state[0], group["id"], state[1], state[2])
+
+    def process_message(self, message):
+        handlers = {
+            "lightcontrol-triggers-pubsub": self.record_trigger,
+            "lightcontrol-timer-pubsub": self.record_timer,
+            "home:broadcast:generic": self.record_broadcast,
+        }
+        try:
+            data = json.loads(message["data"])
+        except (ValueError, TypeError):
+            self.logger.warning("Received invalid message from pubsub: %s", message)
+            return
+        if health.Heartbeat.is_ping(data):
+            # Pings of other services on recorded channels are ignored by beat()
+            self.heartbeat.beat(data)
+            return
+        handlers[message["channel"]](time.time(), data)
+        for date in self.writer.pop_completed_dates():
+            self.logger.info("Writing summary for %s", date)
+            self.reader.get_summary(date)
+
+    def run(self):
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe("lightcontrol-triggers-pubsub", "lightcontrol-timer-pubsub", "home:broadcast:generic", "lightcontrol-recorder-pubsub")
+        self.heartbeat.start()
+        try:
+            while True:
+                message = pubsub.get_message(timeout=1)
+                if message is not None:
+                    self.process_message(message)
+                elif time.time() - self.writer.flushed_at > self.writer.flush_interval:
+                    self.writer.flush()
+        finally:
+            self.writer.flush()
+
+
+def main(args):
+    if args["query"]:
+        start = datetime.datetime.strptime(args["<start>"], "%Y-%m-%d")
+        end = datetime.datetime.strptime(args["<end>"], "%Y-%m-%d")
+        reader = HistoryReader(args["<data-dir>"])
+        print(json.dumps(reader.report(start, end, float(args.get("--watts") or 6.0)), indent=4, sort_keys=True))
+        return
+    kwargs = {
+        "redis_host": args.get("--redis-host"),
+        "redis_port": args.get("--redis-port"),
+    }
+    light_recorder = LightRecorder(args["<data-dir>"], debug=args.get("--debug", False), **kwargs)
+    if args.get("--stats-port"):
+        stats.start_server(light_recorder.stats, args["--stats-port"])
+    light_recorder.run()
+
+
+if __name__ == '__main__':
+    arguments = docopt.docopt(__doc__, version="1.0")
+    main(arguments)
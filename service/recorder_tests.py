@@ -0,0 +1,84 @@
+import datetime
+import recorder
+import shutil
+import tempfile
+import time
+import unittest
+
+
+def timestamp(*args):
+    return time.mktime(datetime.datetime(*args).timetuple())
+
+
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.writer = recorder.ChunkWriter(self.data_dir)
+        self.reader = recorder.HistoryReader(self.data_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def test_columns(self):
+        self.writer.append(timestamp(2016, 3, 30, 8, 0), recorder.KIND_ON, 1, 50, 1)
+        self.writer.append(timestamp(2016, 3, 30, 9, 0), recorder.KIND_OFF, 1)
+        self.writer.flush()
+        chunk = self.reader.read_chunk(datetime.date(2016, 3, 30))
+        self.assertEqual(list(chunk["kind"]), [recorder.KIND_ON, recorder.KIND_OFF])
+        self.assertEqual(list(chunk["value"]), [50, 0])
+
+    def test_on_time(self):
+        self.writer.append(timestamp(2016, 3, 30, 8, 0), recorder.KIND_TRIGGER, 1)
+        self.writer.append(timestamp(2016, 3, 30, 8, 0), recorder.KIND_ON, 1, 50, 1)
+        self.writer.append(timestamp(2016, 3, 30, 9, 0), recorder.KIND_OFF, 1)
+        self.writer.append(timestamp(2016, 3, 30, 23, 0), recorder.KIND_ON, 2, 100, 1)
+        self.writer.append(timestamp(2016, 3, 31, 1, 0), recorder.KIND_OFF, 2)
+        self.writer.flush()
+        totals = self.reader.query(datetime.datetime(2016, 3, 29), datetime.datetime(2016, 4, 1))
+        self.assertEqual(totals[1].on_seconds, 3600)
+        self.assertEqual(totals[1].brightness_seconds, 1800)
+        self.assertEqual(totals[1].triggers, 1)
+        self.assertEqual(totals[2].on_seconds, 7200)
+        totals = self.reader.query(datetime.datetime(2016, 3, 30, 8, 30), datetime.datetime(2016, 3, 31, 0, 30))
+        self.assertEqual(totals[1].on_seconds, 1800)
+        self.assertEqual(totals[1].triggers, 0)
+        self.assertEqual(totals[2].on_seconds, 5400)
+        report = self.reader.report(datetime.datetime(2016, 3, 30), datetime.datetime(2016, 3, 31), watts=10)
+        self.assertAlmostEqual(report[1]["energy_wh"], 5)
+        self.assertAlmostEqual(report[1]["trigger_rate"], 1 / 24.0)
+
+    def test_summary_is_cached(self):
+        self.writer.append(timestamp(2016, 3, 30, 8, 0), recorder.KIND_ON, 1, 100, 1)
+        self.writer.flush()
+        totals, state = self.reader.get_summary(datetime.date(2016, 3, 30))
+        self.assertEqual(totals[1].on_seconds, 16 * 3600)
+        self.assertEqual(state, {1: 100})
+        totals, state = self.reader.get_summary(datetime.date(2016, 3, 30))
+        self.assertEqual(totals[1].on_seconds, 16 * 3600)
+        self.assertEqual(state, {1: 100})
+
+    def test_state_is_carried_over_days_without_events(self):
+        self.writer.append(timestamp(2016, 3, 1, 10, 0), recorder.KIND_ON, 1, 100, 1)
+        self.writer.append(timestamp(2016, 3, 3, 10, 0), recorder.KIND_OFF, 1)
+        self.writer.flush()
+        for _ in range(2):
+            # Second query uses cached summaries
+            totals = self.reader.query(datetime.datetime(2016, 3, 1), datetime.datetime(2016, 3, 4))
+            self.assertEqual(totals[1].on_seconds, 48 * 3600)
+        totals = self.reader.query(datetime.datetime(2016, 3, 2), datetime.datetime(2016, 3, 3, 12, 0))
+        self.assertEqual(totals[1].on_seconds, 34 * 3600)
+
+    def test_lazy_summaries_over_many_days(self):
+        self.writer.append(timestamp(2016, 3, 1, 0, 0), recorder.KIND_ON, 1, 100, 1)
+        for day in range(1, 13):
+            self.writer.append(timestamp(2016, 3, day, 12, 0), recorder.KIND_TRIGGER, 2)
+        self.writer.flush()
+        totals, state = self.reader.get_summary(datetime.date(2016, 3, 12))
+        self.assertEqual(totals[1].on_seconds, 24 * 3600)
+        self.assertEqual(state, {1: 100})
+        totals = self.reader.query(datetime.datetime(2016, 3, 1), datetime.datetime(2016, 3, 13))
+        self.assertEqual(totals[1].on_seconds, 288 * 3600)
+        self.assertEqual(totals[2].triggers, 12)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+"""Program schedule - compiled index of program intervals
+
+Programs are expanded to concrete intervals for a window of days. Intervals
+are split into non-overlapping segments per group (programs without groups
+go to a shared index), each segment pointing to the highest-priority program
+running during it. Finding the program for a group at a given time is a
+binary search over segment start times.
+"""
+
+import bisect
+import datetime
+
+
+class ProgramInterval(object):
+    __slots__ = ("start", "end", "program")
+
+    def __init__(self, start, end, program):
+        self.start = start
+        self.end = end
+        self.program = program
+
+    def percent_done(self, now):
+        return (now - self.start).total_seconds() / (self.end - self.start).total_seconds()
+
+    def __repr__(self):
+        return u"ProgramInterval<%s: %s - %s>" % (self.program.name, self.start, self.end)
+
+
+class SegmentIndex(object):
+    def __init__(self, intervals):
+        self.starts = []
+        self.segments = []
+        self.build(intervals)
+
+    @classmethod
+    def rank(cls, interval):
+        # Higher priority wins; on equal priority, the program that started later wins.
+        return (interval.program.priority, interval.start)
+
+    def build(self, intervals):
+        boundaries = sorted(set([interval.start for interval in intervals] + [interval.end for interval in intervals]))
+        by_start = sorted(intervals, key=lambda interval: interval.start)
+        active = []
+        position = 0
+        for segment_start, segment_end in zip(boundaries, boundaries[1:]):
+            while position < len(by_start) and by_start[position].start <= segment_start:
+                active.append(by_start[position])
+                position += 1
+            active = [interval for interval in active if interval.end > segment_start]
+            if not active:
+                continue
+            winner = max(active, key=self.rank)
+            if self.segments and self.segments[-1][1] is winner and self.segments[-1][0] == segment_start:
+                # Extend the previous segment
+                self.segments[-1][0] = segment_end
+                continue
+            self.starts.append(segment_start)
+            self.segments.append([segment_end, winner])
+
+    def lookup(self, now):
+        i = bisect.bisect_right(self.starts, now) - 1
+        if i < 0:
+            return None
+        segment_end, interval = self.segments[i]
+        if now < segment_end:
+            return interval
+        return None
+
+
+class ProgramSchedule(object):
+    def __init__(self, programs, holidays, start_date, days=8):
+        """ Compiles programs for days starting from start_date.
+
+        holidays is a collection of datetime.date objects.
+        """
+        self.programs = programs
+        self.holidays = set(holidays)
+        self.start = datetime.datetime.combine(start_date, datetime.time())
+        self.end = self.start + datetime.timedelta(days=days)
+        self.intervals = {}
+        self.indexes = {}
+        self.day_intervals = {}
+        self.compile()
+
+    def applies_on(self, program, date):
+        if date in self.holidays:
+            if program.holidays == "only":
+                return True
+            if program.holidays == "skip":
+                return False
+        elif program.holidays == "only":
+            return False
+        return date.weekday() in program.days
+
+    def expand(self, program):
+        start_at_time = program.start_at_time
+        duration = datetime.timedelta(seconds=program.duration)
+        # Start from earlier days, as programs may continue past midnight.
+        date = self.start.date() - datetime.timedelta(days=duration.days + 1)
+        intervals = []
+        while date < self.end.date():
+            if self.applies_on(program, date):
+                start = datetime.datetime.combine(date, start_at_time)
+                end = start + duration
+                if end > self.start and end > start:
+                    intervals.append(ProgramInterval(start, end, program))
+            date += datetime.timedelta(days=1)
+        return intervals
+
+    def compile(self):
+        by_group = {}
+        for program in self.programs:
+            intervals = self.expand(program)
+            self.intervals[program.name] = intervals
+            for group_id in program.groups or (None,):
+                by_group.setdefault(group_id, []).extend(intervals)
+            if not program.groups and program.tod in ("morning", "evening"):
+                for interval in intervals:
+                    key = (interval.start.date(), program.tod)
+                    current = self.day_intervals.get(key)
+                    if current is None or SegmentIndex.rank(interval) > SegmentIndex.rank(current):
+                        self.day_intervals[key] = interval
+        self.indexes = dict((group_id, SegmentIndex(intervals)) for group_id, intervals in by_group.items())
+
+    def lookup(self, group_id, now):
+        """ Returns ProgramInterval applying to group_id at now, or None.
+
+        With group_id=None, only programs without explicit groups are considered.
+        """
+        interval = None
+        if None in self.indexes:
+            interval = self.indexes[None].lookup(now)
+        if group_id is not None and group_id in self.indexes:
+            group_interval = self.indexes[group_id].lookup(now)
+            if group_interval is not None:
+                # Group-specific programs win over shared programs with equal priority
+                if interval is None or group_interval.program.priority >= interval.program.priority:
+                    interval = group_interval
+        return interval
+
+    def day_interval(self, date, tod):
+        """ Returns interval of the shared tod ("morning" or "evening") program starting on date, or None """
+        return self.day_intervals.get((date, tod))
+
+    def next_interval(self, program_name, now):
+        """ Returns currently running or next interval for a program, or None if not within the schedule """
+        for interval in self.intervals.get(program_name, []):
+            if interval.end > now:
+                return interval
+        return None
@@ -0,0 +1,77 @@
+import datetime
+import programs
+import schedule
+import unittest
+
+
+def make_programs():
+    return [programs.LightProgram.from_data(name, data) for name, data in sorted(programs.DEFAULT_PROGRAMS.items())]
+
+
+class TestProgramSchedule(unittest.TestCase):
+    def setUp(self):
+        self.schedule = schedule.ProgramSchedule(make_programs(), [], datetime.date(2016, 3, 28))
+
+    def test_lookup(self):
+        interval = self.schedule.lookup(1, datetime.datetime(2016, 3, 30, 8, 34))
+        self.assertEqual(interval.program.name, "morning-weekday")
+        self.assertEqual(interval.start, datetime.datetime(2016, 3, 30, 8, 15))
+        self.assertIsNone(self.schedule.lookup(1, datetime.datetime(2016, 3, 30, 9, 34)))
+        interval = self.schedule.lookup(None, datetime.datetime(2016, 4, 1, 23, 10))
+        self.assertEqual(interval.program.name, "evening-weekend")
+        interval = self.schedule.lookup(None, datetime.datetime(2016, 4, 2, 9, 45))
+        self.assertEqual(interval.program.name, "morning-weekend")
+
+    def test_past_midnight(self):
+        late = programs.LightProgram.from_data("late", {"tod": "evening", "start_at": "23:30", "duration": 3600, "days": [0]})
+        late_schedule = schedule.ProgramSchedule([late], [], datetime.date(2016, 3, 29))
+        interval = late_schedule.lookup(1, datetime.datetime(2016, 3, 29, 0, 15))
+        self.assertEqual(interval.program.name, "late")
+        self.assertAlmostEqual(interval.percent_done(datetime.datetime(2016, 3, 29, 0, 15)), 0.75)
+
+    def test_group_programs_and_priority(self):
+        kitchen = programs.LightProgram.from_data("kitchen", {"tod": "evening", "start_at": "22:00", "duration": 7200, "groups": [3]})
+        override = programs.LightProgram.from_data("override", {"tod": "evening", "start_at": "22:45", "duration": 600, "priority": 10})
+        group_schedule = schedule.ProgramSchedule(make_programs() + [kitchen, override], [], datetime.date(2016, 3, 28))
+        now = datetime.datetime(2016, 3, 30, 22, 40)
+        self.assertEqual(group_schedule.lookup(3, now).program.name, "kitchen")
+        self.assertEqual(group_schedule.lookup(1, now).program.name, "evening-weekday")
+        self.assertEqual(group_schedule.lookup(None, now).program.name, "evening-weekday")
+        now = datetime.datetime(2016, 3, 30, 22, 50)
+        self.assertEqual(group_schedule.lookup(3, now).program.name, "override")
+        self.assertEqual(group_schedule.lookup(1, now).program.name, "override")
+        now = datetime.datetime(2016, 3, 30, 23, 10)
+        self.assertEqual(group_schedule.lookup(3, now).program.name, "kitchen")
+        self.assertIsNone(group_schedule.lookup(1, now))
+
+    def test_holidays(self):
+        holiday = programs.LightProgram.from_data("holiday-morning", {"tod": "morning", "start_at": "10:00", "duration": 3600, "holidays": "only"})
+        weekday = programs.LightProgram.from_data("morning-weekday", {"start_at": "08:15", "duration": 3600, "holidays": "skip"})
+        holiday_schedule = schedule.ProgramSchedule([holiday, weekday], [datetime.date(2016, 3, 28)], datetime.date(2016, 3, 28))
+        self.assertIsNone(holiday_schedule.lookup(1, datetime.datetime(2016, 3, 28, 8, 30)))
+        self.assertEqual(holiday_schedule.lookup(1, datetime.datetime(2016, 3, 28, 10, 30)).program.name, "holiday-morning")
+        self.assertEqual(holiday_schedule.lookup(1, datetime.datetime(2016, 3, 29, 8, 30)).program.name, "morning-weekday")
+        self.assertIsNone(holiday_schedule.lookup(1, datetime.datetime(2016, 3, 29, 10, 30)))
+        self.assertEqual(holiday_schedule.next_interval("morning-weekday", datetime.datetime(2016, 3, 28, 7, 0)).start, datetime.datetime(2016, 3, 29, 8, 15))
+
+    def test_day_interval(self):
+        morning = self.schedule.day_interval(datetime.date(2016, 3, 30), "morning")
+        self.assertEqual(morning.program.name, "morning-weekday")
+        evening = self.schedule.day_interval(datetime.date(2016, 4, 1), "evening")
+        self.assertEqual(evening.end, datetime.datetime(2016, 4, 1, 23, 30))
+        kitchen = programs.LightProgram.from_data("morning-kitchen", {"start_at": "06:00", "duration": 600, "groups": [3]})
+        group_schedule = schedule.ProgramSchedule([kitchen], [], datetime.date(2016, 3, 28))
+        self.assertIsNone(group_schedule.day_interval(datetime.date(2016, 3, 30), "morning"))
+
+    def test_curves(self):
+        program = programs.LightProgram.from_data("dim", {"tod": "evening", "start_at": "22:00", "duration": 3600, "brightness_curve": [[0, 80], [0.5, 20], [1, 0]], "color": [[0, "white"], [0.5, "red"]]})
+        self.assertEqual(program.brightness_at(0), 80)
+        self.assertEqual(program.brightness_at(0.25), 50)
+        self.assertEqual(program.brightness_at(0.75), 10)
+        self.assertEqual(program.color_at(0.25), "white")
+        self.assertEqual(program.color_at(0.5), "red")
+        evening = make_programs()[0]
+        self.assertEqual(evening.brightness_at(0.25), 75)
+
+if __name__ == '__main__':
+    unittest.main()
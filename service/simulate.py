@@ -0,0 +1,232 @@
+"""Light simulation - replays triggers through all services in virtual time
+
+Usage:
+    simulate.py run <start> <end> [--log=<filename> | --history=<data-dir>] [--rate=<triggers per hour>] [--seed=<seed>] [--output=<filename>] [--debug] [--redis-host=<hostname>] [--redis-port=<port>] [--redis-db=<db>]
+
+Triggers are read from a log file with one JSON object per line:
+    {"ts": "2016-03-30T08:34:05", "key": "bed"}
+or replayed from sensor events stored by the recorder (--history=<data-dir>).
+Without a log or history, triggers are generated randomly with --rate triggers per hour (default 10),
+using --seed (default 0).
+
+Services share a virtual clock, and messages are delivered in-process instead
+of through pubsub. Redis is still used for state, so use a separate database
+(--redis-db, default 15). The database is flushed before the simulation.
+
+Report with per-stage costs is printed to stdout. LED commands are written
+to --output, one JSON object per line.
+"""
+
+import clock
+import collections
+import control
+import datetime
+import docopt
+import functools
+import json
+import logging
+import programs
+import random
+import recorder
+import stats
+import time
+import timers
+import triggers
+
+SYNTHETIC_SENSORS = ("bed", "balcony-door-pir", "table-center", "kitchen-ceiling", "kitchen-room", "hall-kitchen", "corridor-pir", "outer-door")
+
+
+class SimulationRedis(stats.CountingStrictRedis):
+    """ Redis client that delivers published messages to simulation message queue instead of Redis """
+
+    def __init__(self, queue, service_stats, **kwargs):
+        super(SimulationRedis, self).__init__(service_stats, **kwargs)
+        self.queue = queue
+
+    def publish(self, channel, message):
+        self.stats.incr("redis:PUBLISH")
+        self.queue.append((channel, message))
+        return 1
+
+
+class RecordingLedController(object):
+    """ Replaces ledcontroller.LedController, recording commands with virtual timestamps """
+
+    def __init__(self, virtual_clock):
+        self.clock = virtual_clock
+        self.commands = []
+
+    def record(self, command, group, arg=None):
+        self.commands.append({"ts": self.clock.now().isoformat(), "command": command, "group": group, "arg": arg})
+
+    def on(self, group=None):
+        self.record("on", group)
+
+    def off(self, group=None):
+        self.record("off", group)
+
+    def set_color(self, color, group=None):
+        self.record("set_color", group, color)
+
+    def set_brightness(self, percent, group=None):
+        self.record("set_brightness", group, percent)
+
+    def batch_run(self, *commands):
+        for command in commands:
+            command[0](*command[1:])
+
+
+def read_trigger_log(filename):
+    events = []
+    with open(filename) as log_file:
+        for line in log_file:
+            line = line.strip()
+            if not line:
+                continue
+            data = json.loads(line)
+            events.append((datetime.datetime.strptime(data["ts"], "%Y-%m-%dT%H:%M:%S"), data["key"]))
+    return sorted(events)
+
+
+def read_recorded_triggers(data_dir, start, end):
+    """ Returns sensor triggers between start and end from recorder data directory """
+    reader = recorder.HistoryReader(data_dir)
+    start_timestamp = time.mktime(start.timetuple())
+    end_timestamp = time.mktime(end.timetuple())
+    events = []
+    date = start.date()
+    while date <= end.date():
+        chunk = reader.read_chunk(date)
+        timestamps, kinds, values = chunk["ts"], chunk["kind"], chunk["value"]
+        for i in range(len(timestamps)):
+            if kinds[i] == recorder.KIND_SENSOR and start_timestamp <= timestamps[i] < end_timestamp:
+                events.append((datetime.datetime.fromtimestamp(timestamps[i]), reader.dictionary.get_value(values[i])))
+        date += datetime.timedelta(days=1)
+    return events
+
+
+def generate_triggers(start, end, rate, seed=0):
+    """ Generates triggers with exponentially distributed intervals (rate per hour) """
+    generator = random.Random(seed)
+    events = []
+    now = start
+    while True:
+        now += datetime.timedelta(seconds=int(generator.expovariate(rate / 3600.0)) + 1)
+        if now >= end:
+            return events
+        events.append((now, generator.choice(SYNTHETIC_SENSORS)))
+
+
+class Simulation(object):
+    def __init__(self, start, **kwargs):
+        self.clock = clock.VirtualClock(start)
+        self.queue = collections.deque()
+        self.led = RecordingLedController(self.clock)
+        redis_class = functools.partial(SimulationRedis, self.queue, db=int(kwargs.pop("redis_db", None) or 15))
+        redis_args = {}
+        if kwargs.get("redis_host"):
+            redis_args["host"] = kwargs["redis_host"]
+        if kwargs.get("redis_port"):
+            redis_args["port"] = kwargs["redis_port"]
+        redis_class(stats.ServiceStats("simulation"), **redis_args).flushdb()
+
+        service_kwargs = dict(kwargs, clock=self.clock, redis_class=redis_class)
+        self.triggers = triggers.LightTriggers(**service_kwargs)
+        self.timers = timers.LightTimers(**service_kwargs)
+        self.control = control.LightControlService("simulation", led=self.led, **service_kwargs)
+        self.programs = programs.LightPrograms(**service_kwargs)
+        if not kwargs.get("debug"):
+            for service in (self.triggers, self.timers, self.control, self.programs):
+                service.logger.setLevel(logging.WARNING)
+        self.handlers = {
+            "lightcontrol-triggers-pubsub": ("triggers", self.triggers.process_command),
+            "lightcontrol-timer-pubsub": ("timers", self.timers.process_message),
+            "lightcontrol-control-pubsub": ("control", self.control.process_command),
+        }
+        self.stages = stats.ServiceStats("simulation")
+
+    def deliver(self):
+        while self.queue:
+            channel, message = self.queue.popleft()
+            self.stages.incr("messages:%s" % channel)
+            if channel not in self.handlers:
+                continue
+            stage, handler = self.handlers[channel]
+            started_at = time.time()
+            handler(json.loads(message))
+            self.stages.add_timing(stage, time.time() - started_at)
+
+    def run(self, events, end, tick_interval=20):
+        """ Runs triggers (list of (datetime, sensor key)), timers and program ticks until end """
+        started_at = time.time()
+        start = self.clock.now()
+        events = collections.deque(sorted(events))
+        next_tick = start
+        while True:
+            timer_at = self.clock.next_timer_at()
+            candidates = [next_tick]
+            if timer_at is not None:
+                candidates.append(timer_at)
+            if events:
+                candidates.append(events[0][0])
+            moment = min(candidates)
+            if moment >= end:
+                break
+            if moment == timer_at:
+                step_started_at = time.time()
+                self.clock.run_next_timer()
+                self.stages.add_timing("timer-expiry", time.time() - step_started_at)
+            elif events and moment == events[0][0]:
+                self.clock.advance_to(moment)
+                self.queue.append(("lightcontrol-triggers-pubsub", json.dumps({"key": events.popleft()[1]})))
+            else:
+                self.clock.advance_to(moment)
+                step_started_at = time.time()
+                self.programs.tick(moment)
+                self.stages.add_timing("programs", time.time() - step_started_at)
+                next_tick += datetime.timedelta(seconds=tick_interval)
+            self.deliver()
+        self.clock.advance_to(end)
+        wall_seconds = time.time() - started_at
+        virtual_seconds = (end - start).total_seconds()
+        return {
+            "virtual_seconds": virtual_seconds,
+            "wall_seconds": wall_seconds,
+            "speedup": virtual_seconds / wall_seconds if wall_seconds > 0 else None,
+            "led_commands": len(self.led.commands),
+            "stages": self.stages.dump(),
+            "services": dict((name, service.stats.dump()) for name, service in (
+                ("triggers", self.triggers),
+                ("timers", self.timers),
+                ("control", self.control),
+                ("programs", self.programs),
+            )),
+        }
+
+
+def main(args):
+    start = datetime.datetime.strptime(args["<start>"], "%Y-%m-%dT%H:%M:%S")
+    end = datetime.datetime.strptime(args["<end>"], "%Y-%m-%dT%H:%M:%S")
+    if args.get("--log"):
+        events = read_trigger_log(args["--log"])
+    elif args.get("--history"):
+        events = read_recorded_triggers(args["--history"], start, end)
+    else:
+        events = generate_triggers(start, end, float(args.get("--rate") or 10), int(args.get("--seed") or 0))
+    kwargs = {
+        "redis_host": args.get("--redis-host"),
+        "redis_port": args.get("--redis-port"),
+        "redis_db": args.get("--redis-db"),
+    }
+    simulation = Simulation(start, debug=args.get("--debug", False), **kwargs)
+    report = simulation.run(events, end)
+    if args.get("--output"):
+        with open(args["--output"], "w") as output:
+            for command in simulation.led.commands:
+                output.write(json.dumps(command) + "\n")
+    print(json.dumps(report, indent=4, sort_keys=True))
+
+
+if __name__ == '__main__':
+    arguments = docopt.docopt(__doc__, version="1.0")
+    main(arguments)
@@ -0,0 +1,34 @@
+import datetime
+import recorder
+import shutil
+import simulate
+import tempfile
+import time
+import unittest
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def test_read_recorded_triggers(self):
+        writer = recorder.ChunkWriter(self.data_dir)
+        dictionary = recorder.ChunkDictionary(self.data_dir)
+        for moment, kind, key in (
+                (datetime.datetime(2016, 3, 30, 7, 0), recorder.KIND_SENSOR, "bed"),
+                (datetime.datetime(2016, 3, 30, 8, 0), recorder.KIND_SENSOR, "outer-door"),
+                (datetime.datetime(2016, 3, 30, 8, 0), recorder.KIND_TRIGGER, None),
+                (datetime.datetime(2016, 3, 31, 1, 0), recorder.KIND_SENSOR, "bed")):
+            writer.append(time.mktime(moment.timetuple()), kind, 0, dictionary.get_code(key))
+        writer.flush()
+        events = simulate.read_recorded_triggers(self.data_dir, datetime.datetime(2016, 3, 30, 7, 30), datetime.datetime(2016, 3, 31, 6, 0))
+        self.assertEqual(events, [
+            (datetime.datetime(2016, 3, 30, 8, 0), "outer-door"),
+            (datetime.datetime(2016, 3, 31, 1, 0), "bed"),
+        ])
+
+if __name__ == '__main__':
+    unittest.main()
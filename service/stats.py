@@ -0,0 +1,248 @@
+"""Runtime statistics - timings, counters and a sampling profiler
+
+Statistics are served as JSON from a local HTTP endpoint:
+
+    GET /stats               timings and counters
+    GET /stats/reset         clear timings and counters
+    GET /profiler            profiler samples collected so far
+    GET /profiler/start      start sampling (optional ?interval=<seconds>)
+    GET /profiler/stop       stop sampling
+"""
+
+import functools
+import json
+import logging
+import redis
+import sys
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import urlparse, parse_qs
+
+
+def timed(name):
+    """ Decorator for collecting timing of a method to self.stats """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            start = time.time()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                self.stats.add_timing(name, time.time() - start)
+        return wrapper
+    return decorator
+
+
+class SamplingProfiler(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = False
+        self.generation = 0
+        self.interval = 0.01
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.samples = 0
+            self.self_counts = {}
+            self.total_counts = {}
+            self.started_at = None
+            self.stopped_at = None
+
+    @classmethod
+    def frame_key(cls, frame):
+        code = frame.f_code
+        return "%s:%s (%s)" % (code.co_filename, code.co_firstlineno, code.co_name)
+
+    def start(self, interval=None):
+        if self.running:
+            return False
+        if interval is not None:
+            self.interval = interval
+        self.reset()
+        self.running = True
+        self.generation += 1
+        self.started_at = time.time()
+        self.thread = threading.Thread(target=self.sample_loop, args=(self.generation,), name="lightcontrol-profiler")
+        self.thread.daemon = True
+        self.thread.start()
+        return True
+
+    def stop(self):
+        if not self.running:
+            return False
+        self.running = False
+        self.stopped_at = time.time()
+        return True
+
+    def sample(self):
+        own_thread = threading.current_thread().ident
+        frames = sys._current_frames()
+        with self.lock:
+            for thread_id, frame in frames.items():
+                if thread_id == own_thread:
+                    continue
+                self.samples += 1
+                key = self.frame_key(frame)
+                self.self_counts[key] = self.self_counts.get(key, 0) + 1
+                seen = set()
+                while frame is not None:
+                    key = self.frame_key(frame)
+                    if key not in seen:
+                        seen.add(key)
+                        self.total_counts[key] = self.total_counts.get(key, 0) + 1
+                    frame = frame.f_back
+
+    def sample_loop(self, generation):
+        # Sampler threads started before a stop/start cycle exit instead of double-counting samples
+        while self.running and self.generation == generation:
+            self.sample()
+            time.sleep(self.interval)
+
+    def dump(self, limit=50):
+        with self.lock:
+            self_counts = sorted(self.self_counts.items(), key=lambda item: item[1], reverse=True)[:limit]
+            total_counts = sorted(self.total_counts.items(), key=lambda item: item[1], reverse=True)[:limit]
+            return {
+                "running": self.running,
+                "interval": self.interval,
+                "started_at": self.started_at,
+                "stopped_at": self.stopped_at,
+                "samples": self.samples,
+                "self": self_counts,
+                "total": total_counts,
+            }
+
+
+class ServiceStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.profiler = SamplingProfiler()
+        self.started_at = time.time()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.timings = {}
+            self.counters = {}
+            self.reset_at = time.time()
+
+    def incr(self, key, amount=1):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def add_timing(self, name, elapsed):
+        with self.lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                self.timings[name] = [1, elapsed, elapsed]
+            else:
+                timing[0] += 1
+                timing[1] += elapsed
+                if elapsed > timing[2]:
+                    timing[2] = elapsed
+
+    def dump(self):
+        with self.lock:
+            timings = {}
+            for name, (count, total, max_elapsed) in self.timings.items():
+                timings[name] = {
+                    "count": count,
+                    "total": total,
+                    "avg": total / count,
+                    "max": max_elapsed,
+                }
+            return {
+                "service": self.name,
+                "started_at": self.started_at,
+                "reset_at": self.reset_at,
+                "timings": timings,
+                "counters": dict(self.counters),
+                "profiler_running": self.profiler.running,
+            }
+
+
+class CountingStrictPipeline(redis.client.StrictPipeline):
+    """ StrictPipeline that counts queued commands and executed pipelines to ServiceStats """
+
+    def __init__(self, stats, *args, **kwargs):
+        super(CountingStrictPipeline, self).__init__(*args, **kwargs)
+        self.stats = stats
+
+    def execute_command(self, *args, **kwargs):
+        self.stats.incr("redis:%s" % args[0])
+        return super(CountingStrictPipeline, self).execute_command(*args, **kwargs)
+
+    def execute(self, raise_on_error=True):
+        if self.command_stack:
+            self.stats.incr("redis:EXEC" if self.transaction else "redis:pipeline")
+        return super(CountingStrictPipeline, self).execute(raise_on_error)
+
+
+class CountingStrictRedis(redis.StrictRedis):
+    """ StrictRedis client that counts executed commands to ServiceStats """
+
+    def __init__(self, stats, **kwargs):
+        super(CountingStrictRedis, self).__init__(**kwargs)
+        self.stats = stats
+
+    def execute_command(self, *args, **options):
+        self.stats.incr("redis:%s" % args[0])
+        return super(CountingStrictRedis, self).execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return CountingStrictPipeline(self.stats, self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class StatsRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        self.server.logger.debug("stats endpoint: " + format, *args)
+
+    def send_json(self, data, status=200):
+        content = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        service_stats = self.server.stats
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        path = url.path.rstrip("/")
+        if path == "/stats":
+            self.send_json(service_stats.dump())
+        elif path == "/stats/reset":
+            service_stats.reset()
+            self.send_json(service_stats.dump())
+        elif path == "/profiler":
+            self.send_json(service_stats.profiler.dump(int(query.get("limit", [50])[0])))
+        elif path == "/profiler/start":
+            interval = query.get("interval")
+            if interval:
+                interval = float(interval[0])
+            self.send_json({"started": service_stats.profiler.start(interval)})
+        elif path == "/profiler/stop":
+            self.send_json({"stopped": service_stats.profiler.stop()})
+        else:
+            self.send_json({"error": "Not found: %s" % url.path}, 404)
+
+
+def start_server(service_stats, port, host="127.0.0.1"):
+    """ Serves service_stats from a background thread. Binds to localhost by default. """
+    server = HTTPServer((host, int(port)), StatsRequestHandler)
+    server.stats = service_stats
+    server.logger = logging.getLogger("lightcontrol-stats")
+    thread = threading.Thread(target=server.serve_forever, name="lightcontrol-stats")
+    thread.daemon = True
+    thread.start()
+    return server
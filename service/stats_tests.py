@@ -0,0 +1,111 @@
+import json
+import stats
+import threading
+import time
+import unittest
+
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
+
+class TimedService(object):
+    def __init__(self):
+        self.stats = stats.ServiceStats("test")
+
+    @stats.timed("work")
+    def work(self, fail=False):
+        if fail:
+            raise ValueError("failed")
+        return 1
+
+
+class TestServiceStats(unittest.TestCase):
+    def setUp(self):
+        self.stats = stats.ServiceStats("test")
+
+    def test_counters(self):
+        self.stats.incr("led:sent")
+        self.stats.incr("led:sent", 3)
+        self.stats.incr("led:suppressed")
+        self.assertEqual(self.stats.dump()["counters"], {"led:sent": 4, "led:suppressed": 1})
+        self.stats.reset()
+        self.assertEqual(self.stats.dump()["counters"], {})
+
+    def test_timings(self):
+        self.stats.add_timing("tick", 0.5)
+        self.stats.add_timing("tick", 1.5)
+        timing = self.stats.dump()["timings"]["tick"]
+        self.assertEqual(timing["count"], 2)
+        self.assertEqual(timing["total"], 2.0)
+        self.assertEqual(timing["avg"], 1.0)
+        self.assertEqual(timing["max"], 1.5)
+
+    def test_timed(self):
+        service = TimedService()
+        self.assertEqual(service.work(), 1)
+        self.assertRaises(ValueError, service.work, True)
+        self.assertEqual(service.stats.dump()["timings"]["work"]["count"], 2)
+
+
+class TestCountingStrictRedis(unittest.TestCase):
+    def test_pipeline_commands_are_counted(self):
+        service_stats = stats.ServiceStats("test")
+        pipe = stats.CountingStrictRedis(service_stats).pipeline()
+        self.assertIsInstance(pipe, stats.CountingStrictPipeline)
+        # Commands are only queued - no connection is needed
+        pipe.get("a")
+        pipe.mget(["a", "b"])
+        pipe.mget(["c"])
+        self.assertEqual(service_stats.dump()["counters"], {"redis:GET": 1, "redis:MGET": 2})
+
+
+class TestSamplingProfiler(unittest.TestCase):
+    def setUp(self):
+        self.profiler = stats.SamplingProfiler()
+
+    def tearDown(self):
+        self.profiler.stop()
+
+    def profiler_threads(self):
+        return [thread for thread in threading.enumerate() if thread.name == "lightcontrol-profiler"]
+
+    def test_restart(self):
+        self.assertTrue(self.profiler.start(0.05))
+        self.assertFalse(self.profiler.start(0.05))
+        first_thread = self.profiler.thread
+        self.assertTrue(self.profiler.stop())
+        self.assertFalse(self.profiler.stop())
+        self.assertTrue(self.profiler.start(0.05))
+        first_thread.join(1)
+        self.assertFalse(first_thread.is_alive())
+        self.assertEqual(self.profiler_threads(), [self.profiler.thread])
+        time.sleep(0.2)
+        self.assertGreater(self.profiler.dump()["samples"], 0)
+
+
+class TestStatsServer(unittest.TestCase):
+    def setUp(self):
+        self.stats = stats.ServiceStats("test")
+        self.server = stats.start_server(self.stats, 0)
+        self.url = "http://127.0.0.1:%s" % self.server.server_address[1]
+
+    def tearDown(self):
+        self.stats.profiler.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get(self, path):
+        return json.loads(urlopen(self.url + path).read().decode("utf-8"))
+
+    def test_endpoints(self):
+        self.stats.incr("errors")
+        self.assertEqual(self.get("/stats")["counters"], {"errors": 1})
+        self.assertEqual(self.get("/stats/reset")["counters"], {})
+        self.assertEqual(self.get("/profiler/start?interval=0.05"), {"started": True})
+        self.assertTrue(self.get("/profiler")["running"])
+        self.assertEqual(self.get("/profiler/stop"), {"stopped": True})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,30 +1,36 @@
 """Light timers - handles timers
 
 Usage:
-    timers.py run [--debug] [--redis-host=<hostname>] [--redis-port=<port>]
+    timers.py run [--debug] [--redis-host=<hostname>] [--redis-port=<port>] [--stats-port=<port>]
 
 """
 
 import datetime
+import clock
 import docopt
+import health
 import json
 import logging
 import multiprocessing
-import redis
-import threading
+import occupancy
+import stats
 import os
 
 
 class LightTimers(object):
     def __init__(self, **kwargs):
+        self.stats = stats.ServiceStats("timers")
         redis_args = {}
         if "redis_host" in kwargs and kwargs["redis_host"]:
             redis_args["host"] = kwargs["redis_host"]
         if "redis_port" in kwargs and kwargs["redis_port"]:
             redis_args["port"] = kwargs["redis_port"]
-        self.redis = redis.StrictRedis(**redis_args)
+        self.redis = kwargs.get("redis_class", stats.CountingStrictRedis)(self.stats, **redis_args)
+        self.clock = kwargs.get("clock") or clock.SystemClock()
         self.timers = {}
         self.timers_length = {}
+        self.occupancy = occupancy.OccupancyModel()
+        self.heartbeat = health.Heartbeat("timers", self.redis, "lightcontrol-timer-pubsub")
 
         self.logger = logging.getLogger("lightcontrol-timers")
         if kwargs.get("debug"):
@@ -39,15 +45,32 @@ class LightTimers(object):
 
     def off_timer(self, group_id):
         self.logger.info("off: %s", group_id)
+        self.occupancy.record_off(group_id, self.clock.time())
         self.redis.publish("lightcontrol-control-pubsub", json.dumps({"group": group_id, "command": "off", "source": "trigger"}))
+        self.redis.set("lightcontrol-occupancy-%s" % group_id, json.dumps(self.occupancy.dump(group_id)))
 
+    def adaptive_timer_length(self, group_id, base_length, max_length):
+        now = self.clock.time()
+        flapped, baseline_flapped = self.occupancy.record_trigger(group_id, now, base_length)
+        if baseline_flapped:
+            self.stats.incr("occupancy:baseline_flaps")
+        if flapped:
+            self.stats.incr("occupancy:flaps")
+            self.logger.info("Group %s was triggered soon after the timer expired: %s", group_id, self.occupancy.dump(group_id))
+        length = self.occupancy.timer_length(group_id, base_length, now, max_length)
+        self.logger.debug("Adaptive timer length for group %s: %ss (base length %ss)", group_id, length, base_length)
+        return length
+
+    @stats.timed("start_timer")
     def start_timer(self, group_id, length, **kwargs):
         self.logger.info("auto-trigger: %s", group_id)
         self.redis.publish("lightcontrol-control-pubsub", json.dumps({"group": group_id, "command": "auto-triggered", "source": "trigger"}))
+        if kwargs.get("adaptive", False):
+            length = self.adaptive_timer_length(group_id, length, kwargs.get("max_length"))
 
         if group_id in self.timers_length:
             current_timer_expire_time = self.timers_length[group_id]
-            new_expire_time = datetime.datetime.now() + datetime.timedelta(seconds=length)
+            new_expire_time = self.clock.now() + datetime.timedelta(seconds=length)
             if not kwargs.get("force", False) and current_timer_expire_time > new_expire_time:
                 self.logger.info("Timer for group %s is set to expire later than new expire time: %s > %s. Skip updating the timer.", group_id, current_timer_expire_time, new_expire_time)
                 return
@@ -55,13 +78,13 @@ class LightTimers(object):
         if self.timers.get(group_id):
             self.logger.debug("Cancelling old timer for %s", group_id)
             self.timers.get(group_id).cancel()
-        timer = threading.Timer(length, self.off_timer, [group_id])
-        timer.start()
+        timer = self.clock.timer(length, self.off_timer, [group_id])
         self.logger.info("Started a new timer for group %s, length %ss", group_id, length)
         self.timers[group_id] = timer
-        self.timers_length[group_id] = datetime.datetime.now() + datetime.timedelta(seconds=length)
+        self.timers_length[group_id] = self.clock.now() + datetime.timedelta(seconds=length)
+        self.redis.setex("lightcontrol-timer-%s-expires-at" % group_id, int(length) + 1, self.timers_length[group_id].isoformat())
 
-    def run(self):
+    def process_message(self, data):
         """
         Expects input in following format:
         {
@@ -69,27 +92,49 @@ class LightTimers(object):
             "duration": <length in seconds>,
             "force": True/False,
         }
+
+        Without duration, timer length from lightcontrol-timer-length is scaled by group occupancy.
         """
+        timer_length = data.get("duration")
+        # Default timer length is adapted to occupancy - explicit durations (morning programs) are used as-is.
+        adaptive = timer_length is None
+        max_length = None
+        if adaptive:
+            timer_length, max_length = self.redis.mget("lightcontrol-timer-length", "lightcontrol-timer-max-length")
+            if max_length is not None:
+                max_length = float(max_length)
+            if timer_length is None:
+                timer_length = 120
+                self.logger.debug("Using default timer (%ss), as timer_length is not available from redis or command message", timer_length)
+            else:
+                timer_length = float(timer_length)
+                self.logger.debug("Using timer length from redis: %ss", timer_length)
+        else:
+            self.logger.debug("Using timer length from command message: %ss", timer_length)
+        if data["group"] == 0:
+            for group_id in range(1, 5):
+                self.start_timer(group_id, timer_length, adaptive=adaptive, max_length=max_length)
+        else:
+            self.start_timer(data["group"], timer_length, force=data.get("force", False), adaptive=adaptive, max_length=max_length)
+
+    def run(self):
         pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
         pubsub.subscribe("lightcontrol-timer-pubsub")
+        self.heartbeat.start()
         for message in pubsub.listen():
-            data = json.loads(message["data"])
-            timer_length = data.get("duration")
-            if timer_length is None:
-                timer_length = self.redis.get("lightcontrol-timer-length")
-                if timer_length is None:
-                    timer_length = 120
-                    self.logger.debug("Using default timer (%ss), as timer_length is not available from redis or command message", timer_length)
-                else:
-                    timer_length = float(timer_length)
-                    self.logger.debug("Using timer length from redis: %ss", timer_length)
-            else:
-                self.logger.debug("Using timer length from command message: %ss", timer_length)
-            if data["group"] == 0:
-                for group_id in range(1, 5):
-                    self.start_timer(group_id, timer_length)
-            else:
-                self.start_timer(data["group"], timer_length, force=data.get("force", False))
+            try:
+                data = json.loads(message["data"])
+            except (ValueError, TypeError):
+                self.logger.warning("Received invalid message from pubsub: %s", message)
+                continue
+            if self.heartbeat.is_ping(data):
+                self.heartbeat.beat(data)
+                continue
+            try:
+                self.process_message(data)
+            except Exception:
+                self.stats.incr("errors")
+                self.logger.exception("Processing %s failed", data)
 
 
 def main(args):
@@ -98,6 +143,8 @@ def main(args):
         "redis_port": args.get("--redis-post"),
     }
     light_timers = LightTimers(debug=args.get("--debug", False), **kwargs)
+    if args.get("--stats-port"):
+        stats.start_server(light_timers.stats, args["--stats-port"])
     light_timers.run()
 
 
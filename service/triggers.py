@@ -1,12 +1,14 @@
 """Light triggers
 
 Usage:
-    triggers.py run [--debug] [--redis-host=<hostname>] [--redis-port=<port>]
+    triggers.py run [--debug] [--redis-host=<hostname>] [--redis-port=<port>] [--stats-port=<port>]
 
 """
 
-import redis
+import clock
+import stats
 import docopt
+import health
 import os
 import json
 import logging
@@ -14,12 +16,14 @@ import logging
 
 class LightTriggers(object):
     def __init__(self, **kwargs):
+        self.stats = stats.ServiceStats("triggers")
         redis_args = {}
         if "redis_host" in kwargs and kwargs["redis_host"]:
             redis_args["host"] = kwargs["redis_host"]
         if "redis_port" in kwargs and kwargs["redis_port"]:
             redis_args["port"] = kwargs["redis_port"]
-        self.redis = redis.StrictRedis(**redis_args)
+        self.redis = kwargs.get("redis_class", stats.CountingStrictRedis)(self.stats, **redis_args)
+        self.clock = kwargs.get("clock") or clock.SystemClock()
 
         self.logger = logging.getLogger("lightcontrol-triggers")
         if kwargs.get("debug"):
@@ -31,7 +35,12 @@ class LightTriggers(object):
         ch = logging.StreamHandler()
         ch.setFormatter(formatter)
         self.logger.addHandler(ch)
+        self.heartbeat = health.Heartbeat("triggers", self.redis, "lightcontrol-triggers-pubsub")
+        self.backpressure = health.Backpressure(self.redis)
+        self.coalesce_window = 10
+        self.published_at = {}
 
+    @stats.timed("process_command")
     def process_command(self, command):
         if "key" not in command:
             self.logger.error("No key specified: %s", command)
@@ -58,13 +67,21 @@ class LightTriggers(object):
         if trigger == "hall-kitchen":
             triggers.update([KITCHEN, DOOR])
 
+        now = self.clock.time()
         for group_id in triggers:
+            if self.backpressure.active() and now - self.published_at.get(group_id, 0) < self.coalesce_window:
+                # Downstream is lagging - timer for this group was refreshed just a moment ago.
+                self.logger.debug("Coalescing trigger for group %s", group_id)
+                self.stats.incr("backpressure:coalesced")
+                continue
             self.logger.debug("Updating group %s", group_id)
+            self.published_at[group_id] = now
             self.redis.publish("lightcontrol-timer-pubsub", json.dumps({"group": group_id}))
 
     def run(self):
         pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
         pubsub.subscribe("lightcontrol-triggers-pubsub")
+        self.heartbeat.start()
         for message in pubsub.listen():
             try:
                 command = json.loads(message["data"])
@@ -72,7 +89,14 @@ class LightTriggers(object):
             except (ValueError, TypeError):
                 self.logger.warning("Received invalid command from pubsub: %s", message)
                 continue
-            self.process_command(command)
+            if self.heartbeat.is_ping(command):
+                self.heartbeat.beat(command)
+                continue
+            try:
+                self.process_command(command)
+            except Exception:
+                self.stats.incr("errors")
+                self.logger.exception("Processing %s failed", command)
 
 
 def main(args):
@@ -81,6 +105,8 @@ def main(args):
         "redis_port": args.get("--redis-post"),
     }
     light_triggers = LightTriggers(debug=arguments.get("--debug", False), **kwargs)
+    if args.get("--stats-port"):
+        stats.start_server(light_triggers.stats, args["--stats-port"])
     light_triggers.run()
 
 
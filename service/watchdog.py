@@ -0,0 +1,135 @@
+"""Light watchdog - monitors service heartbeats and pubsub output buffers
+
+Usage:
+    watchdog.py run [--debug] [--redis-host=<hostname>] [--redis-port=<port>] [--stats-port=<port>] [--max-lag=<seconds>] [--max-omem=<bytes>]
+
+Services are stalled when their heartbeat is missing or older than three
+heartbeat intervals. Each instance registered to lightcontrol-health-instances
+is checked separately - remove decommissioned instances with HDEL. Backpressure is set (lightcontrol-backpressure) when
+loop lag exceeds --max-lag (default 2s), or when a pubsub subscriber's output
+buffer exceeds --max-omem (default 1MB) or keeps growing.
+"""
+
+import docopt
+import json
+import logging
+import stats
+import time
+
+SERVICES = ("triggers", "timers", "control", "programs", "recorder")
+
+
+class LightWatchdog(object):
+    def __init__(self, **kwargs):
+        self.stats = stats.ServiceStats("watchdog")
+        redis_args = {}
+        if "redis_host" in kwargs and kwargs["redis_host"]:
+            redis_args["host"] = kwargs["redis_host"]
+        if "redis_port" in kwargs and kwargs["redis_port"]:
+            redis_args["port"] = kwargs["redis_port"]
+        self.redis = kwargs.get("redis_class", stats.CountingStrictRedis)(self.stats, **redis_args)
+        self.max_lag = float(kwargs.get("max_lag") or 2)
+        self.max_omem = int(kwargs.get("max_omem") or 1024 * 1024)
+        self.growth_checks = 3
+        self.interval = 5
+        self.subscribers = {}
+        self.status = None
+
+        self.logger = logging.getLogger("lightcontrol-watchdog")
+        if kwargs.get("debug"):
+            self.logger.setLevel(logging.DEBUG)
+        else:
+            self.logger.setLevel(logging.INFO)
+        format_string = "%(asctime)s - %(levelname)s - %(message)s"
+        formatter = logging.Formatter(format_string)
+        ch = logging.StreamHandler()
+        ch.setFormatter(formatter)
+        self.logger.addHandler(ch)
+
+    def check_services(self, now):
+        problems = {}
+        pressure = []
+        instances = self.redis.hgetall("lightcontrol-health-instances")
+        for service in SERVICES:
+            if service not in instances.values():
+                problems[service] = "stalled: no heartbeat"
+        names = sorted(instances)
+        values = self.redis.mget(["lightcontrol-health-%s" % name for name in names]) if names else []
+        for name, value in zip(names, values):
+            if value is None:
+                problems[name] = "stalled: no heartbeat"
+                continue
+            heartbeat = json.loads(value)
+            if now - heartbeat["ts"] > heartbeat["interval"] * 3:
+                problems[name] = "stalled: last heartbeat %.0fs ago" % (now - heartbeat["ts"])
+            elif heartbeat["lag"] > self.max_lag:
+                problems[name] = "lagging: %.1fs" % heartbeat["lag"]
+                pressure.append(name)
+        return problems, pressure
+
+    def check_subscribers(self):
+        """ Returns pubsub clients with too large or constantly growing output buffers """
+        problems = {}
+        subscribers = {}
+        for client in self.redis.client_list():
+            if int(client.get("sub", 0)) == 0 and int(client.get("psub", 0)) == 0:
+                continue
+            addr = client["addr"]
+            omem = int(client.get("omem", 0))
+            # First sample of a subscriber is not counted as growth
+            previous_omem, growing = self.subscribers.get(addr, (omem, 0))
+            if omem > previous_omem:
+                growing += 1
+            else:
+                growing = 0
+            subscribers[addr] = (omem, growing)
+            if omem > self.max_omem:
+                problems[addr] = "output buffer %s bytes" % omem
+            elif growing >= self.growth_checks:
+                problems[addr] = "output buffer growing: %s bytes" % omem
+        self.subscribers = subscribers
+        return problems
+
+    def check(self, now):
+        service_problems, lagging = self.check_services(now)
+        subscriber_problems = self.check_subscribers()
+        status = {
+            "services": service_problems,
+            "subscribers": subscriber_problems,
+        }
+        if lagging or subscriber_problems:
+            self.stats.incr("watchdog:backpressure")
+            self.redis.setex("lightcontrol-backpressure", self.interval * 2, json.dumps(status))
+        else:
+            self.redis.delete("lightcontrol-backpressure")
+        if status != self.status:
+            if service_problems or subscriber_problems:
+                self.logger.warning("Health problems: %s", status)
+            else:
+                self.logger.info("All services are healthy")
+            self.redis.publish("lightcontrol-health-pubsub", json.dumps(dict(status, service="watchdog", ts=now)))
+            self.status = status
+        return status
+
+    def run(self):
+        while True:
+            self.check(time.time())
+            time.sleep(self.interval)
+
+
+def main(args):
+    kwargs = {
+        "redis_host": args.get("--redis-host"),
+        "redis_port": args.get("--redis-port"),
+        "max_lag": args.get("--max-lag"),
+        "max_omem": args.get("--max-omem"),
+    }
+    light_watchdog = LightWatchdog(debug=args.get("--debug", False), **kwargs)
+    if args.get("--stats-port"):
+        stats.start_server(light_watchdog.stats, args["--stats-port"])
+    light_watchdog.run()
+
+
+if __name__ == '__main__':
+    arguments = docopt.docopt(__doc__, version="1.0")
+    main(arguments)
@@ -0,0 +1,62 @@
+import fake_redis
+import health
+import json
+import time
+import unittest
+import watchdog
+
+
+class TestWatchdog(unittest.TestCase):
+    def setUp(self):
+        fake_redis.FakeCountingRedis.reset()
+        self.redis = fake_redis.FakeCountingRedis(None)
+        self.watchdog = watchdog.LightWatchdog(redis_class=fake_redis.FakeCountingRedis, max_lag=2, max_omem=1000)
+        self.clients = []
+        self.watchdog.redis.client_list = lambda: self.clients
+        self.now = time.time()
+        for service in ("triggers", "timers", "programs", "recorder"):
+            health.Heartbeat(service, self.redis).report(0.1)
+        for instance in ("10.0.0.1", "10.0.0.2"):
+            health.Heartbeat("control", self.redis, instance=instance).report(0.1)
+
+    def test_healthy(self):
+        self.assertEqual(self.watchdog.check_services(self.now), ({}, []))
+        self.assertEqual(self.watchdog.check(self.now), {"services": {}, "subscribers": {}})
+        self.assertFalse(self.redis.exists("lightcontrol-backpressure"))
+
+    def test_dead_instance(self):
+        self.redis.delete("lightcontrol-health-control-10.0.0.2")
+        self.assertEqual(self.watchdog.check_services(self.now), ({"control-10.0.0.2": "stalled: no heartbeat"}, []))
+
+    def test_missing_service(self):
+        self.redis.hdel("lightcontrol-health-instances", "recorder")
+        self.assertEqual(self.watchdog.check_services(self.now), ({"recorder": "stalled: no heartbeat"}, []))
+
+    def test_stale_and_lagging(self):
+        self.assertEqual(self.watchdog.check_services(self.now + 60), (dict(
+            (name, "stalled: last heartbeat 60s ago") for name in ("triggers", "timers", "programs", "recorder", "control-10.0.0.1", "control-10.0.0.2")), []))
+        health.Heartbeat("control", self.redis, instance="10.0.0.1").report(5)
+        problems, pressure = self.watchdog.check_services(self.now)
+        self.assertEqual(problems, {"control-10.0.0.1": "lagging: 5.0s"})
+        self.assertEqual(pressure, ["control-10.0.0.1"])
+        self.watchdog.check(self.now)
+        self.assertTrue(self.redis.exists("lightcontrol-backpressure"))
+
+    def test_growing_output_buffer(self):
+        for omem in (100, 200, 300):
+            self.clients = [{"addr": "127.0.0.1:1000", "sub": "1", "psub": "0", "omem": str(omem)}, {"addr": "127.0.0.1:1001", "sub": "0", "psub": "0", "omem": "5000"}]
+            self.assertEqual(self.watchdog.check_subscribers(), {})
+        self.clients[0]["omem"] = "400"
+        self.assertEqual(self.watchdog.check_subscribers(), {"127.0.0.1:1000": "output buffer growing: 400 bytes"})
+        self.clients[0]["omem"] = "5000"
+        self.assertEqual(self.watchdog.check_subscribers(), {"127.0.0.1:1000": "output buffer 5000 bytes"})
+        self.clients[0]["omem"] = "0"
+        self.assertEqual(self.watchdog.check_subscribers(), {})
+        self.watchdog.check(self.now)
+        self.assertFalse(self.redis.exists("lightcontrol-backpressure"))
+        self.clients[0]["omem"] = "5000"
+        status = self.watchdog.check(self.now)
+        self.assertEqual(json.loads(self.redis.get("lightcontrol-backpressure")), status)
+
+if __name__ == '__main__':
+    unittest.main()